@@ -0,0 +1,616 @@
+import numpy as np
+import argparse, time
+
+
+def Timer(func, repeat: int= 3):
+    '''
+    Returns the best wall time of `repeat` calls and the result of the last call.
+    '''
+    times = []
+    for _ in range(repeat):
+        start_Time = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start_Time)
+
+    return min(times), result
+
+def Synthetic_Voice(seconds: float, sample_rate: int, seed: int= 0):
+    '''
+    Harmonic tone with vibrato, note changes, rests and noise. It is only for timing and parity checks.
+    '''
+    random_State = np.random.RandomState(seed)
+    time_Axis = np.arange(int(seconds * sample_rate)) / sample_rate
+    f0 = 220.0 * 2 ** (random_State.randint(-5, 8, size= int(seconds * 2) + 1)[(time_Axis * 2).astype(int)] / 12)
+    f0 *= 1.0 + 0.01 * np.sin(2 * np.pi * 5.5 * time_Axis)
+    phase = 2 * np.pi * np.cumsum(f0) / sample_rate
+    audio = sum([np.sin(phase * harmonic) / harmonic for harmonic in range(1, 6)])
+    audio *= (np.sin(2 * np.pi * 0.3 * time_Axis) > -0.7)   # rests
+    audio += 0.01 * random_State.randn(audio.shape[0])
+
+    return (audio / np.abs(audio).max()).astype(np.float32)
+
+def YIN_Benchmark(repeat: int= 3):
+    from yin import compute_yin, compute_yin_batch
+    sample_Rate = 48000
+    audio = Synthetic_Voice(seconds= 30.0, sample_rate= sample_Rate)
+    kwargs = {'sr': sample_Rate, 'w_len': 960, 'w_step': 240, 'harmo_thresh': 1 - 0.6}
+
+    loop_Time, (loop_Pitches, loop_Rates, _, _) = Timer(lambda: compute_yin(audio, **kwargs), repeat)
+    batch_Time, (batch_Pitches, batch_Rates, _, _) = Timer(lambda: compute_yin_batch(audio, **kwargs), repeat)
+
+    print('YIN, 30s audio at {}Hz, {} frames'.format(sample_Rate, loop_Pitches.shape[0]))
+    print('    compute_yin:       {:.3f}s'.format(loop_Time))
+    print('    compute_yin_batch: {:.3f}s (x{:.1f})'.format(batch_Time, loop_Time / batch_Time))
+    print('    Different pitch frames: {}, max harmonic rate difference: {:.3e}'.format(
+        (loop_Pitches != batch_Pitches).sum(),
+        np.abs(loop_Rates - batch_Rates).max()
+        ))
+
+def Synthetic_Music(notes: int, seed: int= 0):
+    '''
+    Music list of Pattern_Generate, (position, duration, text, note), with rests and onset/nucleus/coda.
+    '''
+    random_State = np.random.RandomState(seed)
+    music = []
+    position = 0
+    for _ in range(notes):
+        if random_State.rand() < 0.3:
+            duration = int(random_State.randint(10, 200))
+            music.append((position, duration, '<X>', 0))
+            position += duration
+        duration = int(random_State.randint(20, 150))
+        note = int(random_State.randint(40, 80))
+        for text, length in [('ㄱ', 2), ('ㅏ', duration - 4), ('ㅇ_', 2)]:
+            music.append((position, length, text, note))
+            position += length
+
+    return music
+
+def Window_Benchmark(repeat: int= 3):
+    from Pattern_Generator import Window_Enumerate
+    def Window_Enumerate_Loop(music, min_duration, max_duration):    # The previous nested loop
+        windows = []
+        for start_Index in range(len(music)):
+            for end_Index in range(start_Index + 1, len(music), 3):
+                music_Sample = music[start_Index:end_Index]
+                sample_Length = music_Sample[-1][0] + music_Sample[-1][1] - music_Sample[0][0]
+                if sample_Length < min_duration:
+                    continue
+                elif sample_Length > max_duration:
+                    break
+                windows.append((start_Index, end_Index, music_Sample[0][0], music_Sample[-1][0] + music_Sample[-1][1]))
+        return np.array(windows, dtype= np.int64).reshape(-1, 4)
+
+    print('Window enumeration, Min_Duration 600, Max_Duration 1500')
+    for notes in [250, 1000, 4000]:
+        music = Synthetic_Music(notes= notes)
+        loop_Time, loop_Windows = Timer(lambda: Window_Enumerate_Loop(music, 600, 1500), repeat)
+        vectorized_Time, windows = Timer(lambda: Window_Enumerate(music, 600, 1500), repeat)
+        print('    {} notes, {} tokens, {} windows: loop {:.4f}s, vectorized {:.4f}s (x{:.1f}), same: {}'.format(
+            notes,
+            len(music),
+            windows.shape[0],
+            loop_Time,
+            vectorized_Time,
+            loop_Time / vectorized_Time,
+            loop_Windows.shape == windows.shape and (loop_Windows == windows).all()
+            ))
+
+def Mel_Benchmark(repeat: int= 3):
+    from Audio import Mel_Generate, Mel_Extractor
+    sample_Rate = 48000
+    kwargs = {
+        'sample_rate': sample_Rate,
+        'num_mel': 80,
+        'num_frequency': 1025,
+        'window_length': 960,
+        'hop_length': 240,
+        'mel_fmin': 0,
+        'mel_fmax': 22050,
+        'max_abs_value': 4
+        }
+    audios = [Synthetic_Voice(seconds= 10.0, sample_rate= sample_Rate, seed= seed) for seed in range(8)]
+    extractor = Mel_Extractor.Get(**kwargs)
+
+    reference_Time, reference_Mels = Timer(lambda: [Mel_Generate(audio, **kwargs) for audio in audios], repeat)
+    single_Time, single_Mels = Timer(lambda: [extractor(audio) for audio in audios], repeat)
+    batch_Time, batch_Mels = Timer(lambda: extractor.Batch(audios), repeat)
+
+    print('Mel, 8 x 10s audio at {}Hz'.format(sample_Rate))
+    print('    Mel_Generate:          {:.3f}s'.format(reference_Time))
+    print('    Mel_Extractor:         {:.3f}s (x{:.1f})'.format(single_Time, reference_Time / single_Time))
+    print('    Mel_Extractor.Batch:   {:.3f}s (x{:.1f})'.format(batch_Time, reference_Time / batch_Time))
+    print('    Max difference: {:.3e}'.format(max([
+        np.abs(reference_Mel - mel).max()
+        for reference_Mel, mel in zip(reference_Mels, batch_Mels)
+        ])))
+
+def Stream_Benchmark(repeat: int= 3):
+    from Audio import Mel_Extractor
+    from yin import pitch_calc, pitch_calc_stream
+    import tempfile, tracemalloc, os
+    sample_Rate = 48000
+    extractor = Mel_Extractor.Get(
+        sample_rate= sample_Rate,
+        num_mel= 80,
+        num_frequency= 1025,
+        window_length= 960,
+        hop_length= 240,
+        mel_fmin= 0,
+        mel_fmax= 22050,
+        max_abs_value= 4
+        )
+    pitch_Kwargs = {'sr': sample_Rate, 'w_len': 960, 'w_step': 240, 'f0_min': 0, 'f0_max': 500, 'confidence_threshold': 0.6, 'gaussian_smoothing_sigma': 0.0}
+
+    def Full(audio):
+        return extractor(audio), pitch_calc(audio, **pitch_Kwargs)
+    def Stream(audio):  # Blocks are only checked and released.
+        mel_Max = max([np.abs(mel).max() for _, mel in extractor.Stream(audio, block_frames= 2048)])
+        pitch_Max = max([np.abs(pitch).max() for _, pitch in pitch_calc_stream(audio, block_frames= 2048, **pitch_Kwargs)])
+        return mel_Max, pitch_Max
+    def Peak(func, audio):
+        tracemalloc.start()
+        func(audio)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak / 2 ** 20
+
+    print('Streaming features of memory-mapped audio at {}Hz, 2048 frame blocks'.format(sample_Rate))
+    with tempfile.TemporaryDirectory() as temp_Path:
+        for seconds in [30.0, 120.0]:
+            path = os.path.join(temp_Path, 'Audio.npy')
+            np.save(path, Synthetic_Voice(seconds= seconds, sample_rate= sample_Rate))
+            audio = np.load(path, mmap_mode= 'r')
+
+            full_Time, (mel, pitch) = Timer(lambda: Full(audio), repeat)
+            stream_Time, _ = Timer(lambda: Stream(audio), repeat)
+            stream_Mel = np.concatenate([x for _, x in extractor.Stream(audio, block_frames= 2048)])
+            stream_Pitch = np.concatenate([x for _, x in pitch_calc_stream(audio, block_frames= 2048, **pitch_Kwargs)])
+            print('    {:.0f}s: full {:.3f}s, peak {:.1f}MB / stream {:.3f}s, peak {:.1f}MB / max difference mel {:.3e}, pitch {:.3e}'.format(
+                seconds,
+                full_Time,
+                Peak(Full, audio),
+                stream_Time,
+                Peak(Stream, audio),
+                np.abs(mel - stream_Mel).max(),
+                np.abs(pitch - stream_Pitch).max()
+                ))
+            del audio
+
+def Bucket_Benchmark(repeat: int= 3):
+    from Datasets import Bucket_Batch_Sampler
+    lengths = np.random.RandomState(0).randint(600, 1501, size= 20000)    # Min_Duration - Max_Duration
+    print('Padding ratio of 20000 patterns, mel length 600 - 1500, batch size 24')
+    for bucket_Size in [0, 8, 32, 128]:
+        sampler = Bucket_Batch_Sampler(lengths= lengths, batch_size= 24, bucket_size= max(bucket_Size, 1))
+        if bucket_Size == 0:
+            indices = np.random.RandomState(0).permutation(lengths.shape[0])
+            batches = [indices[index:index + 24] for index in range(0, indices.shape[0], 24)]
+            name = 'Random'
+        else:
+            sample_Time, batches = Timer(sampler.Batches, repeat)
+            name = 'Bucket {}'.format(bucket_Size)
+        print('    {:<10}: {:.3f}'.format(name, sampler.Padding_Ratio(batches)) + ('' if bucket_Size == 0 else ', {:.4f}s per epoch'.format(sample_Time)))
+
+    print('Frame budget 24 x 1500, bucket 32')
+    sampler = Bucket_Batch_Sampler(lengths= lengths, batch_size= 24, bucket_size= 32, max_frames= 24 * 1500)
+    sample_Time, batches = Timer(sampler.Batches, repeat)
+    padded_Frames = np.array([len(batch) * lengths[batch].max() for batch in batches])
+    print('    padding ratio {:.3f}, {} batches (fixed size: {}), {:.1f} patterns per batch, padded frames {:.0f} ± {:.0f}, {:.4f}s per epoch'.format(
+        sampler.Padding_Ratio(batches),
+        len(batches),
+        len(Bucket_Batch_Sampler(lengths= lengths, batch_size= 24)),
+        np.mean([len(batch) for batch in batches]),
+        padded_Frames.mean(),
+        padded_Frames.std(),
+        sample_Time
+        ))
+
+def Collater_Benchmark(repeat: int= 3):
+    import torch
+    from Datasets import Collater, Duration_Stack, Token_Stack, Note_Stack, Mel_Stack, Silence_Stack, Pitch_Stack
+    token_Dict = {'<X>': 0}
+    def Stack_Collate(batch):   # The previous collater
+        durations, tokens, notes, mels, silences, pitches = zip(*batch)
+        token_Lengths = [len(token) + 1 for token in tokens]
+        mel_Lengths = [mel.shape[0] for mel in mels]
+        return \
+            torch.LongTensor(Duration_Stack(durations)), \
+            torch.LongTensor(Token_Stack(tokens, token_Dict)), \
+            torch.LongTensor(Note_Stack(notes)), \
+            torch.LongTensor(token_Lengths), \
+            torch.FloatTensor(Mel_Stack(mels, 4.0)).transpose(2, 1), \
+            torch.FloatTensor(Silence_Stack(silences)), \
+            torch.FloatTensor(Pitch_Stack(pitches)), \
+            torch.LongTensor(mel_Lengths)
+
+    random_State = np.random.RandomState(0)
+    batch = []
+    for _ in range(24):
+        music = Synthetic_Music(notes= random_State.randint(10, 20), seed= random_State.randint(1000))
+        _, durations, _, notes = zip(*music)
+        frames = sum(durations)
+        batch.append((
+            durations,
+            [int(x) for x in random_State.randint(1, 78, size= len(music))],
+            notes,
+            random_State.uniform(-4, 4, size= (frames, 80)).astype(np.float32),
+            (random_State.rand(frames) > 0.5).astype(np.uint8),
+            random_State.rand(frames).astype(np.float32)
+            ))
+    collater = Collater(token_dict= token_Dict, max_abs_mel= 4.0)
+
+    stack_Time, stack_Batch = Timer(lambda: [Stack_Collate(batch) for _ in range(20)], repeat)
+    collater_Time, collater_Batch = Timer(lambda: [collater(batch) for _ in range(20)], repeat)
+    print('Collater, 20 batches of 24 patterns, {} - {} frames'.format(min([x[3].shape[0] for x in batch]), max([x[3].shape[0] for x in batch])))
+    print('    Stack collater:        {:.3f}s'.format(stack_Time))
+    print('    Preallocated collater: {:.3f}s (x{:.1f})'.format(collater_Time, stack_Time / collater_Time))
+    print('    Same: {}, mel is contiguous: {}'.format(
+        all([torch.equal(x, y) for x, y in zip(stack_Batch[0], collater_Batch[0])]),
+        collater_Batch[0][4].is_contiguous()
+        ))
+
+def Prefetch_Benchmark(repeat: int= 3):
+    import torch
+    from Datasets import Device_Prefetcher
+    class Slow_Loader:  # 10ms to make a batch, like a DataLoader waiting for its workers
+        def __iter__(self):
+            for index in range(50):
+                time.sleep(0.01)
+                yield torch.full((24, 80, 100), float(index)), torch.arange(24) + index, 'Batch_{}'.format(index)
+        def __len__(self):
+            return 50
+    def Run(loader):    # 10ms of compute per step
+        batches = []
+        wait_Time = 0.0
+        for batch in loader:
+            batches.append(batch)
+            wait_Time += getattr(loader, 'wait_Time', 0.0)
+            time.sleep(0.01)
+        return batches, wait_Time
+
+    direct_Time, (direct_Batches, _) = Timer(lambda: Run(Slow_Loader()), repeat)
+    prefetch_Time, (prefetch_Batches, wait_Time) = Timer(lambda: Run(Device_Prefetcher(Slow_Loader(), 'cpu')), repeat)
+    print('Prefetch, 50 batches, 10ms loading and 10ms compute per batch, CPU')
+    print('    Direct:   {:.3f}s'.format(direct_Time))
+    print('    Prefetch: {:.3f}s (x{:.1f}), data wait {:.3f}s'.format(prefetch_Time, direct_Time / prefetch_Time, wait_Time))
+    print('    Same: {}'.format(
+        len(direct_Batches) == len(prefetch_Batches) and \
+        all([torch.equal(x[0], y[0]) and torch.equal(x[1], y[1]) and x[2] == y[2] for x, y in zip(direct_Batches, prefetch_Batches)])
+        ))
+
+def Encoding_Benchmark(repeat: int= 3):
+    from Audio import Mel_Extractor
+    from Datasets import Quantize, Dequantize, Text_to_Token
+    sample_Rate = 48000
+    mel = Mel_Extractor.Get(
+        sample_rate= sample_Rate,
+        num_mel= 80,
+        num_frequency= 1025,
+        window_length= 960,
+        hop_length= 240,
+        mel_fmin= 0,
+        mel_fmax= 22050,
+        max_abs_value= 4
+        )(Synthetic_Voice(seconds= 60.0, sample_rate= sample_Rate))
+    token_Dict = {'<X>': 0, **{'T{}'.format(index): index for index in range(1, 78)}}
+    text = ['T{}'.format(x) for x in np.random.RandomState(0).randint(1, 78, size= 20000)]
+    token = np.array(Text_to_Token(text, token_Dict), dtype= np.uint8)
+    windows = [(start, start + 600) for start in np.random.RandomState(0).randint(0, mel.shape[0] - 600, size= 1000)]
+
+    codes, scale = Quantize(mel, np.uint8, -4.0, 4.0)
+    encoding_Dict = {
+        'Float32': (mel, lambda x: x.astype(np.float32)),
+        'Float16': (mel.astype(np.float16), lambda x: x.astype(np.float32)),
+        'UInt8': (codes, lambda x: Dequantize(x, *scale)),
+        }
+    print('Encoding, 1000 windows of 600 frames from a {} frames mel'.format(mel.shape[0]))
+    for name, (encoded, decode) in encoding_Dict.items():
+        decode_Time, _ = Timer(lambda: [decode(encoded[start:end]) for start, end in windows], repeat)
+        print('    Mel {:8s} {:5d} bytes/frame, decode: {:.3f}s, max error: {:.3e}'.format(
+            name,
+            encoded.nbytes // encoded.shape[0],
+            decode_Time,
+            np.abs(decode(encoded) - mel).max()
+            ))
+
+    text_Time, _ = Timer(lambda: [Text_to_Token(text[start // 30:end // 30], token_Dict) for start, end in windows], repeat)
+    token_Time, _ = Timer(lambda: [token[start // 30:end // 30].astype(np.int64) for start, end in windows], repeat)
+    print('    Text_to_Token:         {:.3f}s'.format(text_Time))
+    print('    Pre-tokenized:         {:.3f}s (x{:.1f})'.format(token_Time, text_Time / token_Time))
+
+def Metadata_Benchmark(repeat: int= 3):
+    from Datasets import Dataset, Metadata_Index, Bucket_Batch_Sampler
+    import tempfile, pickle, os
+    num_Songs, windows_per_Song = 20000, 200
+    random_State = np.random.RandomState(0)
+    files = ['NAMS/{:03d}/NAMS.S_{:06d}.pickle'.format(index % 1000, index) for index in range(num_Songs)]
+    start_Frames = random_State.randint(0, 20000, size= num_Songs * windows_per_Song)
+    start_Indices = random_State.randint(0, 2000, size= num_Songs * windows_per_Song)
+    metadata_Dict = {
+        'Storage': 'Song',
+        'File_List': files,
+        'Audio_Length_Dict': {file: 240 * 30000 for file in files},
+        'Mel_Length_Dict': {file: 30000 for file in files},
+        'Music_Length_Dict': {file: 3000 for file in files},
+        'Window_Table': np.stack([
+            np.repeat(np.arange(num_Songs), windows_per_Song),
+            start_Indices,
+            start_Indices + random_State.randint(10, 80, size= start_Indices.shape[0]),
+            start_Frames,
+            start_Frames + random_State.randint(600, 1500, size= start_Frames.shape[0])
+            ], axis= 1)
+        }
+
+    with tempfile.TemporaryDirectory() as temp_Path:
+        metadata_Path = os.path.join(temp_Path, 'METADATA.PICKLE')
+        with open(metadata_Path, 'wb') as f:
+            pickle.dump(metadata_Dict, f, protocol= 4)
+        pickle_Time, pickle_Dataset = Timer(lambda: Dataset(temp_Path, 'METADATA.PICKLE', {}), repeat)
+        pickle_Bytes = len(pickle.dumps(pickle_Dataset))
+        Metadata_Index.Generate(metadata_Path, metadata_Dict)
+        index_Time, index_Dataset = Timer(lambda: Dataset(temp_Path, 'METADATA.PICKLE', {}), repeat)
+        index_Bytes = len(pickle.dumps(index_Dataset))
+
+        filter_Time, sampler = Timer(lambda: Bucket_Batch_Sampler(lengths= index_Dataset.mel_Lengths, batch_size= 24, min_length= 700, max_length= 1400), repeat)
+        batches_Time, batches = Timer(lambda: sampler.Batches(), 1)
+
+        print('Metadata, {} songs, {} windows'.format(num_Songs, index_Dataset.base_Length))
+        print('    Pickle: init {:.3f}s, dataset pickled to a spawned worker {:.1f}MB'.format(pickle_Time, pickle_Bytes / 2 ** 20))
+        print('    Index:  init {:.4f}s, dataset pickled to a spawned worker {:.3f}MB'.format(index_Time, index_Bytes / 2 ** 20))
+        print('    Same: {}'.format(
+            np.array_equal(pickle_Dataset.mel_Lengths, index_Dataset.mel_Lengths) and \
+            all([pickle_Dataset.metadata.File(index) == index_Dataset.metadata.File(index) for index in [0, num_Songs // 2, num_Songs - 1]])
+            ))
+        print('    Length filter 700 - 1400: {:.3f}s, {} of {} windows, an epoch of {} batches: {:.3f}s'.format(
+            filter_Time, sampler.num_Patterns, index_Dataset.base_Length, len(batches), batches_Time
+            ))
+        del pickle_Dataset, index_Dataset, sampler   # Memory-maps must be closed before the directory is removed on Windows.
+
+def Length_Regulate_Benchmark(repeat: int= 3):
+    import torch
+    from Modules import Length_Regulate
+    def Loop_Regulate(x, durations):    # The previous loop of Duration_Predictor
+        return torch.stack([
+            encoding.repeat_interleave(duration, dim= 1)
+            for encoding, duration in zip(x, durations)
+            ], dim= 0)
+    def Forward_Backward(regulate, x, durations):
+        x.grad = None
+        y = regulate(x, durations)
+        y.backward(torch.ones_like(y))
+        return y.detach(), x.grad.clone()
+
+    print('Length_Regulate, 384 channels, forward and backward on {}'.format('CUDA' if torch.cuda.is_available() else 'CPU'))
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    for batch_Size in [4, 16, 64]:
+        for tokens in [50, 200]:
+            random_State = np.random.RandomState(0)
+            durations = torch.from_numpy(random_State.randint(1, 30, size= (batch_Size, tokens))).to(device)
+            durations[:, -1] += durations.sum(dim= 1).max() - durations.sum(dim= 1)   # Same sums, as Collater
+            x = torch.randn(batch_Size, 384, tokens, device= device, requires_grad= True)
+
+            loop_Time, (loop_Y, loop_Grad) = Timer(lambda: Forward_Backward(Loop_Regulate, x, durations), repeat)
+            gather_Time, (gather_Y, gather_Grad) = Timer(lambda: Forward_Backward(Length_Regulate, x, durations), repeat)
+            print('    Batch {:2d}, {:3d} tokens, {:4d} frames: loop {:.4f}s, gather {:.4f}s (x{:.1f}), same: {}'.format(
+                batch_Size,
+                tokens,
+                gather_Y.size(2),
+                loop_Time,
+                gather_Time,
+                loop_Time / gather_Time,
+                torch.equal(loop_Y, gather_Y) and torch.allclose(loop_Grad, gather_Grad)
+                ))
+
+def Duration_Inference_Benchmark(repeat: int= 3):
+    import torch, yaml
+    from Arg_Parser import Recursive_Parse
+    from Modules import Duration_Predictor
+    hp = Recursive_Parse(yaml.load(open('Hyper_Parameters.yaml', encoding='utf-8'), Loader=yaml.Loader))
+    duration_Predictor = Duration_Predictor(hp)
+    def Loop_Durations(predicted_durations):  # The previous post-processing of Duration_Predictor
+        durations = predicted_durations.ceil().long().clamp(0, hp.Max_Duration)
+        durations = torch.stack([
+            (torch.ones_like(duration) if duration.sum() == 0 else duration)
+            for duration in durations
+            ], dim= 0)
+        max_Durations = torch.max(torch.cat([duration.sum(dim= 0, keepdim= True) + 1 for duration in durations]))
+        if max_Durations > hp.Max_Duration:
+            return torch.ones_like(durations)
+        return torch.cat([
+            durations[:, :-1], durations[:, -1:] + max_Durations - durations.sum(dim= 1, keepdim= True)
+            ], dim= 1)
+
+    print('Duration inference post-processing, 50 tokens, on CPU')
+    for batch_Size in [1, 16, 256, 1024]:
+        random_State = np.random.RandomState(0)
+        predicted_Durations = torch.from_numpy(random_State.uniform(0, 25, size= (batch_Size, 50)).astype(np.float32))
+        predicted_Durations[0] = 0.0    # A pattern without duration
+        loop_Time, loop_Durations = Timer(lambda: [Loop_Durations(predicted_Durations) for _ in range(10)][-1], repeat)
+        batch_Time, batch_Durations = Timer(lambda: [duration_Predictor.Inference_Durations(predicted_Durations) for _ in range(10)][-1], repeat)
+        print('    Batch {:4d}, 10 times: loop {:.4f}s, batched {:.4f}s (x{:.1f}), same: {}'.format(
+            batch_Size,
+            loop_Time,
+            batch_Time,
+            loop_Time / batch_Time,
+            torch.equal(loop_Durations, batch_Durations)
+            ))
+
+    predicted_Durations[1] = 100.0  # Longer than Max_Duration
+    loop_Durations, batch_Durations = Loop_Durations(predicted_Durations), duration_Predictor.Inference_Durations(predicted_Durations)
+    print('    With a pattern longer than Max_Duration: loop keeps {} of {} patterns, batched keeps {}'.format(
+        int((loop_Durations[:, :-1] == predicted_Durations[:, :-1].ceil().long()).all(dim= 1).sum()),
+        batch_Size,
+        int((batch_Durations[:, :-1] == predicted_Durations[:, :-1].ceil().long()).all(dim= 1).sum())
+        ))
+
+def Discriminator_Benchmark(repeat: int= 3):
+    import torch, yaml
+    from Arg_Parser import Recursive_Parse
+    from Modules import Discriminators, Crop_Offsets
+    hp = Recursive_Parse(yaml.load(open('Hyper_Parameters.yaml', encoding='utf-8'), Loader=yaml.Loader))
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(0)
+    discriminators = Discriminators(hp).to(device)
+    def Loop_Discriminate(x, lengths, offsets): # The previous per-pattern crops and per-band discriminators
+        sampling_Length = lengths.min()
+        discriminations = []
+        for index, frequency_Range in enumerate(hp.Discriminator.Frequency_Range):
+            mels = torch.stack([
+                mel[frequency_Range[0]:frequency_Range[1], offset:offset + sampling_Length]
+                for mel, offset in zip(x, offsets[index])
+                ]).unsqueeze(dim= 1)
+            discriminations.append(discriminators.layer_Dict['Discriminator_{}'.format(index)].layer(mels).squeeze(dim= 1))
+        return discriminations
+    def Forward_Backward(discriminate, x, lengths, offsets):
+        x.grad = None
+        discriminators.zero_grad()
+        discriminations = discriminate(x, lengths, offsets)
+        sum([discrimination.square().mean() for discrimination in discriminations]).backward()
+        return [discrimination.detach() for discrimination in discriminations], x.grad.clone()
+
+    print('Discriminators, {} bands, forward and backward on {}'.format(len(hp.Discriminator.Frequency_Range), 'CUDA' if torch.cuda.is_available() else 'CPU'))
+    for batch_Size in [2, 8]:
+        for frames in [100, 300]:
+            lengths = torch.randint(frames // 2, frames + 1, (batch_Size,), device= device)
+            lengths[0] = frames
+            x = torch.randn(batch_Size, hp.Sound.Mel_Dim, frames, device= device, requires_grad= True)
+            offsets = Crop_Offsets(lengths, int(lengths.min()), len(hp.Discriminator.Frequency_Range))
+
+            loop_Time, (loop_Discriminations, loop_Grad) = Timer(lambda: Forward_Backward(Loop_Discriminate, x, lengths, offsets.tolist()), repeat)
+            grouped_Time, (grouped_Discriminations, grouped_Grad) = Timer(lambda: Forward_Backward(discriminators, x, lengths, offsets), repeat)
+            print('    Batch {}, {:3d} frames: loop {:.4f}s, grouped {:.4f}s (x{:.1f}), same: {}'.format(
+                batch_Size,
+                frames,
+                loop_Time,
+                grouped_Time,
+                loop_Time / grouped_Time,
+                all([
+                    torch.allclose(loop, grouped, atol= 1e-5)
+                    for loop, grouped in zip(loop_Discriminations, grouped_Discriminations)
+                    ]) and torch.allclose(loop_Grad, grouped_Grad, atol= 1e-6)
+                ))
+
+def Attention_Benchmark(repeat: int= 3):
+    import torch, yaml
+    from Arg_Parser import Recursive_Parse
+    from Modules import FFT_Block
+    hp = Recursive_Parse(yaml.load(open('Hyper_Parameters.yaml', encoding='utf-8'), Loader=yaml.Loader))
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(0)
+    fft_Block_Dict = {
+        attention: FFT_Block(
+            in_channels= hp.Decoder.Size,
+            heads= hp.Decoder.FFT_Block.Heads,
+            dropout_rate= 0.0,
+            ff_in_kernel_size= hp.Decoder.FFT_Block.FeedForward.In_Kernel_Size,
+            ff_out_kernel_size= hp.Decoder.FFT_Block.FeedForward.Out_Kernel_Size,
+            ff_channels= hp.Decoder.FFT_Block.FeedForward.Channels,
+            attention= attention
+            ).to(device)
+        for attention in ['Torch', 'SDPA']
+        }
+    fft_Block_Dict['SDPA'].load_state_dict(fft_Block_Dict['Torch'].state_dict())    # Checkpoints are compatible.
+    def Forward_Backward(fft_Block, x, masks, weights):
+        x.grad = None
+        y = fft_Block(x, masks)
+        (y * weights).sum().backward()
+        return y.detach(), x.grad.clone()
+
+    print('FFT_Block of decoder, batch 4, forward and backward on {}'.format('CUDA' if torch.cuda.is_available() else 'CPU'))
+    for frames in [600, 1000, 1500]:
+        x = torch.randn(4, hp.Decoder.Size, frames, device= device, requires_grad= True)
+        masks = torch.arange(frames, device= device)[None, :] >= torch.LongTensor([frames, frames * 3 // 4, frames // 2, frames // 4]).to(device)[:, None]
+        weights = torch.randn_like(x)
+
+        torch_Time, (torch_Y, torch_Grad) = Timer(lambda: Forward_Backward(fft_Block_Dict['Torch'], x, masks, weights), repeat)
+        sdpa_Time, (sdpa_Y, sdpa_Grad) = Timer(lambda: Forward_Backward(fft_Block_Dict['SDPA'], x, masks, weights), repeat)
+        with torch.no_grad():
+            torch_Inference_Time, _ = Timer(lambda: fft_Block_Dict['Torch'](x, masks), repeat)
+            sdpa_Inference_Time, _ = Timer(lambda: fft_Block_Dict['SDPA'](x, masks), repeat)
+        print('    {:4d} frames: train torch {:.4f}s, sdpa {:.4f}s (x{:.2f}) / inference torch {:.4f}s, sdpa {:.4f}s (x{:.2f}), same: {}'.format(
+            frames,
+            torch_Time,
+            sdpa_Time,
+            torch_Time / sdpa_Time,
+            torch_Inference_Time,
+            sdpa_Inference_Time,
+            torch_Inference_Time / sdpa_Inference_Time,
+            torch.allclose(torch_Y, sdpa_Y, atol= 1e-4) and torch.allclose(torch_Grad, sdpa_Grad, atol= 1e-4)
+            ))
+
+def Local_Attention_Benchmark(repeat: int= 3):
+    import torch, yaml
+    from Arg_Parser import Recursive_Parse
+    from Modules import Multihead_Attention
+    hp = Recursive_Parse(yaml.load(open('Hyper_Parameters.yaml', encoding='utf-8'), Loader=yaml.Loader))
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(0)
+    attention_Dict = {
+        window: Multihead_Attention(
+            embed_dim= hp.Decoder.Size,
+            num_heads= hp.Decoder.FFT_Block.Heads,
+            window= window
+            ).to(device)
+        for window in [None, 64, 256]
+        }
+    for attention in attention_Dict.values():
+        attention.load_state_dict(attention_Dict[None].state_dict())
+    def Forward_Backward(attention, x, masks):
+        x.grad = None
+        attention(x, masks).sum().backward()
+    def Peak_Memory(func):  # CUDA only
+        if not torch.cuda.is_available():
+            return None
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        func()
+        torch.cuda.synchronize()
+        return torch.cuda.max_memory_allocated() / 2 ** 20
+
+    print('Decoder attention, batch 1, forward and backward on {}. Scores: MB of the attention score tensor.'.format('CUDA' if torch.cuda.is_available() else 'CPU'))
+    for frames in [1500, 3000, 6000]:
+        x = torch.randn(1, hp.Decoder.Size, frames, device= device, requires_grad= True)
+        masks = torch.arange(frames, device= device)[None, :] >= frames - 100
+        for window, attention in attention_Dict.items():
+            keys = frames if window is None or window >= frames - 1 else 3 * window
+            train_Time, _ = Timer(lambda: Forward_Backward(attention, x, masks), repeat)
+            with torch.no_grad():
+                inference_Time, _ = Timer(lambda: attention(x, masks), repeat)
+            peak_Memory = Peak_Memory(lambda: Forward_Backward(attention, x, masks))
+            print('    {:4d} frames, {:>4s} window: train {:.4f}s, inference {:.4f}s, scores {:7.1f}MB{}'.format(
+                frames,
+                str(window or 'full'),
+                train_Time,
+                inference_Time,
+                hp.Decoder.FFT_Block.Heads * frames * keys * 4 / 2 ** 20,
+                '' if peak_Memory is None else ', peak {:.1f}MB'.format(peak_Memory)
+                ))
+
+benchmark_Dict = {
+    'YIN': YIN_Benchmark,
+    'Window': Window_Benchmark,
+    'Mel': Mel_Benchmark,
+    'Stream': Stream_Benchmark,
+    'Bucket': Bucket_Benchmark,
+    'Collater': Collater_Benchmark,
+    'Prefetch': Prefetch_Benchmark,
+    'Encoding': Encoding_Benchmark,
+    'Metadata': Metadata_Benchmark,
+    'Length_Regulate': Length_Regulate_Benchmark,
+    'Duration_Inference': Duration_Inference_Benchmark,
+    'Discriminator': Discriminator_Benchmark,
+    'Attention': Attention_Benchmark,
+    'Local_Attention': Local_Attention_Benchmark,
+    }
+
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('-b', '--benchmark', nargs= '+', default= list(benchmark_Dict.keys()), choices= list(benchmark_Dict.keys()))
+    argParser.add_argument('-r', '--repeat', default= 3, type= int)
+    args = argParser.parse_args()
+
+    for benchmark in args.benchmark:
+        benchmark_Dict[benchmark](repeat= args.repeat)
+
+# python Benchmark.py -b YIN
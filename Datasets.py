@@ -3,13 +3,72 @@
 
 import torch
 import numpy as np
-import pickle, os
+import pickle, os, math, time, threading, atexit
+from queue import Queue, Full
 from random import randint
-from multiprocessing import Manager
+from collections import OrderedDict, deque
+from multiprocessing import Lock
+from multiprocessing.shared_memory import SharedMemory
 
 def Text_to_Token(text: list, token_dict: dict):
     return [token_dict[x] for x in text]
 
+def Pattern_Header(pattern_dict: dict):
+    return {
+        'Header': True,
+        'Keys': tuple(pattern_dict.keys()),
+        'Audio_Length': pattern_dict['Audio'].shape[0],
+        'Mel_Length': pattern_dict['Mel'].shape[0],
+        'Music_Length': len(pattern_dict['Duration']),
+        }
+
+def Pattern_Load(path: str):
+    '''
+    A pattern file of window storage is a small header pickle followed by the pattern pickle.
+    Old pattern files without the header are also loaded.
+    '''
+    with open(path, 'rb') as f:
+        pattern_Dict = pickle.load(f)
+        if pattern_Dict.get('Header', False):
+            pattern_Dict = pickle.load(f)
+
+    return pattern_Dict
+
+def Pattern_Header_Load(path: str):
+    '''
+    Reads only the header. Old pattern files are read fully to make it.
+    '''
+    with open(path, 'rb') as f:
+        pattern_Dict = pickle.load(f)
+
+    return pattern_Dict if pattern_Dict.get('Header', False) else Pattern_Header(pattern_Dict)
+
+def Song_Array_Path(path: str, song_dict: dict):
+    '''
+    The path of a song pickle without the extension, to which '.<Key>.npy' of the song arrays is added.
+    An eval song which shares the arrays of the train song has 'Array_Path', relative to the directory of its pickle.
+    '''
+    if 'Array_Path' in song_dict.keys():
+        return os.path.join(os.path.dirname(path), song_dict['Array_Path']).replace('\\', '/')
+
+    return os.path.splitext(path)[0]
+
+def Quantize(array: np.ndarray, dtype: type, min_value: float, max_value: float):
+    '''
+    Maps [min_value, max_value] linearly to the whole range of an unsigned integer dtype.
+    Returns the codes and (scale, offset) for Dequantize.
+    '''
+    scale = (max_value - min_value) / np.iinfo(dtype).max
+    codes = np.rint((np.clip(array, min_value, max_value) - min_value) / scale).astype(dtype)
+
+    return codes, (scale, min_value)
+
+def Dequantize(codes: np.ndarray, scale: float, offset: float):
+    array = np.multiply(codes, np.float32(scale), dtype= np.float32)
+    array += np.float32(offset)
+
+    return array
+
 def Mel_Stack(mels: list, max_abs_mel: float):
     max_Mel_Length = max([mel.shape[0] for mel in mels])
     mels = np.stack(
@@ -80,6 +139,219 @@ def Note_Stack(notes: list):
     return notes
 
 
+class Pattern_Cache:
+    '''
+    LRU cache of patterns in shared memory.
+    The arena is split to fixed-size slots, and a pattern is saved as the raw bytes of its arrays.
+    The slot table (the slot of each key, the key and last use of each slot, the array shapes) and counters are also in shared memory,
+    so every DataLoader worker reads and writes the cache directly. Only a lock is shared between processes.
+    Patterns bigger than slot_bytes are not cached.
+    The slots are not more than the keys, so a small dataset does not reserve the whole max_bytes.
+    The owner process unlinks the shared memory by Close, or at exit if it is not closed.
+    '''
+    def __init__(self, max_bytes: int, slot_bytes: int, num_keys: int, num_arrays: int= 6):
+        self.slot_Bytes = int(slot_bytes)
+        self.num_Slots = min(max(int(max_bytes) // self.slot_Bytes, 1), int(num_keys))
+        self.num_Keys = int(num_keys)
+        self.num_Arrays = num_arrays
+        self.owner_PID = os.getpid()
+        self.lock = Lock()
+
+        self.arena = SharedMemory(create= True, size= self.num_Slots * self.slot_Bytes)
+        self.table = SharedMemory(create= True, size= 8 * (4 + self.num_Keys + self.num_Slots * (2 + self.num_Arrays * 4)))
+        atexit.register(self.Close)
+        self.Attach()
+        self.counters[:] = 0
+        self.key_Slots[:] = -1
+        self.slot_Keys[:] = -1
+        self.slot_Times[:] = 0
+
+    def Attach(self):
+        table = np.ndarray((self.table.size // 8,), dtype= np.int64, buffer= self.table.buf)
+        offset = 0
+        self.counters = table[offset:offset + 4]; offset += 4   # Hit, Miss, Eviction, Clock
+        self.key_Slots = table[offset:offset + self.num_Keys]; offset += self.num_Keys
+        self.slot_Keys = table[offset:offset + self.num_Slots]; offset += self.num_Slots
+        self.slot_Times = table[offset:offset + self.num_Slots]; offset += self.num_Slots
+        self.slot_Headers = table[offset:].reshape(self.num_Slots, self.num_Arrays, 4)    # dtype char, ndim, shape[0], shape[1]
+        self.arena_Array = np.ndarray((self.arena.size,), dtype= np.uint8, buffer= self.arena.buf)
+
+    def __getstate__(self):  # Spawned workers attach to the same shared memory.
+        return {
+            'slot_Bytes': self.slot_Bytes,
+            'num_Slots': self.num_Slots,
+            'num_Keys': self.num_Keys,
+            'num_Arrays': self.num_Arrays,
+            'owner_PID': self.owner_PID,
+            'lock': self.lock,
+            'names': (self.arena.name, self.table.name),
+            }
+
+    def __setstate__(self, state):
+        arena_Name, table_Name = state.pop('names')
+        self.__dict__.update(state)
+        try:
+            self.arena, self.table = SharedMemory(name= arena_Name, track= False), SharedMemory(name= table_Name, track= False)
+        except TypeError:   # Python < 3.13
+            self.arena, self.table = SharedMemory(name= arena_Name), SharedMemory(name= table_Name)
+        self.Attach()
+
+    def Get(self, key: int):
+        with self.lock:
+            slot = self.key_Slots[key]
+            if slot < 0:
+                self.counters[1] += 1
+                return None
+            self.counters[0] += 1
+            self.counters[3] += 1
+            self.slot_Times[slot] = self.counters[3]
+            headers = self.slot_Headers[slot].copy()
+            sizes = [np.dtype(chr(char)).itemsize * int(np.prod([shape_0, shape_1][:ndim])) for char, ndim, shape_0, shape_1 in headers]
+            data = self.arena_Array[slot * self.slot_Bytes:slot * self.slot_Bytes + sum(sizes)].copy()
+
+        arrays = []
+        offset = 0
+        for (char, ndim, shape_0, shape_1), size in zip(headers, sizes):
+            array = data[offset:offset + size].view(np.dtype(chr(char)))
+            arrays.append(array.reshape([shape_0, shape_1][:ndim]))
+            offset += size
+
+        return tuple(arrays)
+
+    def Put(self, key: int, pattern: tuple):
+        arrays = [np.ascontiguousarray(x) for x in pattern]
+        if sum([array.nbytes for array in arrays]) > self.slot_Bytes:
+            return
+
+        with self.lock:
+            if self.key_Slots[key] >= 0:
+                return
+            empty_Slots = np.flatnonzero(self.slot_Keys < 0)
+            slot = empty_Slots[0] if empty_Slots.shape[0] > 0 else np.argmin(self.slot_Times)
+            if self.slot_Keys[slot] >= 0:
+                self.key_Slots[self.slot_Keys[slot]] = -1
+                self.counters[2] += 1
+
+            offset = slot * self.slot_Bytes
+            for index, array in enumerate(arrays):
+                self.arena_Array[offset:offset + array.nbytes] = array.reshape(-1).view(np.uint8)
+                self.slot_Headers[slot, index] = [ord(array.dtype.char), array.ndim] + (list(array.shape) + [0, 0])[:2]
+                offset += array.nbytes
+            self.slot_Keys[slot] = key
+            self.key_Slots[key] = slot
+            self.counters[3] += 1
+            self.slot_Times[slot] = self.counters[3]
+
+    def Info(self):
+        hits, misses, evictions, _ = self.counters.tolist()
+        return {
+            'Hit': hits,
+            'Miss': misses,
+            'Eviction': evictions,
+            'Hit_Rate': hits / max(hits + misses, 1),
+            'Used_Slots': int((self.slot_Keys >= 0).sum()),
+            'Slots': self.num_Slots,
+            }
+
+    def Close(self):
+        for name in ['counters', 'key_Slots', 'slot_Keys', 'slot_Times', 'slot_Headers', 'arena_Array']:
+            self.__dict__.pop(name, None)   # Views must be released before closing.
+        for shared_Memory in [self.__dict__.pop('arena', None), self.__dict__.pop('table', None)]:
+            if shared_Memory is None:
+                continue
+            shared_Memory.close()
+            if os.getpid() == self.owner_PID:
+                shared_Memory.unlink()
+        if os.getpid() == self.owner_PID:
+            atexit.unregister(self.Close)
+
+    def __del__(self):
+        self.Close()
+
+class Metadata_Index:
+    '''
+    Columnar form of a metadata pickle, '<Metadata>.INDEX.PICKLE' and '<Metadata>.INDEX.<Column>.npy'.
+    The index pickle has only the scalar entries. The file names are a string table, the utf-8 bytes of all names(File_Bytes) and their offsets(File_Offset).
+    The other entries of each file(Audio_Length, Mel_Length, Music_Length) and of each pattern(Pattern_Length) are numpy columns,
+    with Window_Table and Shard_Index when they exist.
+    Columns are memory-mapped when they are used first, so loading does not depend on the corpus size and
+    all processes reading the same index share the pages. Pickling drops the opened maps, and DataLoader workers open them again.
+    When the index does not exist or is older than the metadata pickle, the pickle is loaded and converted in memory.
+    '''
+    def __init__(self, metadata_path: str):
+        self.index_Path = '{}.INDEX'.format(os.path.splitext(metadata_path)[0])
+        self.indexed = \
+            os.path.exists('{}.PICKLE'.format(self.index_Path)) and \
+            os.path.getmtime('{}.PICKLE'.format(self.index_Path)) >= os.path.getmtime(metadata_path)
+        if self.indexed:
+            self.header = pickle.load(open('{}.PICKLE'.format(self.index_Path), 'rb'))
+            self.column_Dict = {}
+        else:
+            self.header, self.column_Dict = Metadata_Index.Columns(pickle.load(open(metadata_path, 'rb')))
+
+    @staticmethod
+    def Columns(metadata_dict: dict):
+        file_Bytes = [file.encode('utf-8') for file in metadata_dict['File_List']]
+        column_Dict = {
+            'File_Offset': np.cumsum([0] + [len(x) for x in file_Bytes], dtype= np.int64),
+            'File_Bytes': np.frombuffer(b''.join(file_Bytes), dtype= np.uint8),
+            }
+        for key in ['Audio_Length', 'Mel_Length', 'Music_Length']:
+            column_Dict[key] = np.array([metadata_dict['{}_Dict'.format(key)][file] for file in metadata_dict['File_List']], dtype= np.int64)
+        for key in ['Window_Table', 'Shard_Index']:
+            if key in metadata_dict.keys():
+                column_Dict[key] = np.asarray(metadata_dict[key], dtype= np.int64)
+
+        if 'Window_Table' in column_Dict.keys():  # Song and shard storages
+            column_Dict['Pattern_Length'] = column_Dict['Window_Table'][:, 4] - column_Dict['Window_Table'][:, 3]
+            pattern_Music_Lengths = column_Dict['Window_Table'][:, 2] - column_Dict['Window_Table'][:, 1]
+        else:
+            column_Dict['Pattern_Length'] = column_Dict['Mel_Length']
+            pattern_Music_Lengths = column_Dict['Music_Length']
+
+        header = {
+            key: value
+            for key, value in metadata_dict.items()
+            if key != 'File_List' and not key.endswith('_Dict') and not key in column_Dict.keys()
+            }
+        header['Columns'] = list(column_Dict.keys())
+        header['Num_Files'] = len(metadata_dict['File_List'])
+        header['Num_Patterns'] = column_Dict['Pattern_Length'].shape[0]
+        header['Max_Pattern_Length'] = int(column_Dict['Pattern_Length'].max(initial= 0))
+        header['Max_Pattern_Music_Length'] = int(pattern_Music_Lengths.max(initial= 0))
+
+        return header, column_Dict
+
+    @staticmethod
+    def Generate(metadata_path: str, metadata_dict: dict):
+        index_Path = '{}.INDEX'.format(os.path.splitext(metadata_path)[0])
+        header, column_Dict = Metadata_Index.Columns(metadata_dict)
+        for key, column in column_Dict.items():
+            np.save('{}.{}.npy'.format(index_Path, key), column)
+        with open('{}.PICKLE'.format(index_Path), 'wb') as f:  # The header is written last, so a partial index is older than the metadata.
+            pickle.dump(header, f, protocol= 4)
+
+    def Column(self, key: str):
+        if not key in self.column_Dict.keys():
+            self.column_Dict[key] = np.load('{}.{}.npy'.format(self.index_Path, key), mmap_mode= 'r')
+
+        return self.column_Dict[key]
+
+    def Has(self, key: str):
+        return key in self.header['Columns']
+
+    def File(self, index: int):
+        file_Offset = self.Column('File_Offset')
+
+        return self.Column('File_Bytes')[file_Offset[index]:file_Offset[index + 1]].tobytes().decode('utf-8')
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.indexed:
+            state['column_Dict'] = {}
+
+        return state
+
 class Dataset(torch.utils.data.Dataset):
     def __init__(
         self,
@@ -87,36 +359,373 @@ class Dataset(torch.utils.data.Dataset):
         Metadata_file: str,
         token_dict: dict,
         accumulated_dataset_epoch: int= 1,
-        use_cache: bool= False
+        use_cache: bool= False,
+        max_open_songs: int= 64,
+        cache_bytes: int= 2 ** 31
         ):
         super(Dataset, self).__init__()
         self.pattern_Path = pattern_path
         self.token_Dict = token_dict
         self.use_cache = use_cache
+        self.accumulated_Dataset_Epoch = accumulated_dataset_epoch
 
         self.metadata_Path = os.path.join(pattern_path, Metadata_file).replace('\\', '/')
-        metadata_Dict = pickle.load(open(self.metadata_Path, 'rb'))
-        self.patterns = metadata_Dict['File_List']
-        self.base_Length = len(self.patterns)
-        self.patterns *= accumulated_dataset_epoch
-        
-        self.cache_Dict = Manager().dict()
+        self.metadata = Metadata_Index(self.metadata_Path)
+        self.storage = self.metadata.header.get('Storage', 'Window')
+        self.base_Length = self.metadata.header['Num_Patterns']
+
+        # Shard storage: arrays are memory-mapped lazily, so DataLoader workers do not receive copies of them.
+        self.shard_Scale = self.metadata.header.get('Shard_Scale', {})    # (scale, offset) of the quantized arrays.
+        self.shard_Dict = None
+
+        # Song storage: memory-mapped songs opened by this worker. This is bounded to limit the open files.
+        self.max_Open_Songs = max_open_songs
+        self.song_Dict = OrderedDict()
+
+        # Shared by all DataLoader workers. A slot is the largest pattern, estimated by the bytes per frame and per note of the first pattern.
+        self.pattern_Cache = None
+        if self.use_cache and self.base_Length > 0:
+            pattern = [np.asarray(x) for x in self.Load(0)]
+            self.shard_Dict, self.song_Dict = None, OrderedDict()   # Not to pass the opened memory-maps to workers.
+            self.pattern_Cache = Pattern_Cache(
+                max_bytes= cache_bytes,
+                slot_bytes= \
+                    self.metadata.header['Max_Pattern_Music_Length'] * sum([x.nbytes for x in pattern[:3]]) // pattern[0].shape[0] + \
+                    self.metadata.header['Max_Pattern_Length'] * sum([x.nbytes for x in pattern[3:]]) // pattern[3].shape[0],
+                num_keys= self.base_Length,
+                num_arrays= len(pattern)
+                )
+
+    @property
+    def mel_Lengths(self):
+        '''
+        The mel length of each pattern. It is memory-mapped when the metadata has the index.
+        '''
+        return self.metadata.Column('Pattern_Length')
 
     def __getitem__(self, idx: int):
-        if (idx % self.base_Length) in self.cache_Dict.keys():
-            return self.cache_Dict[self.metadata_Path, idx % self.base_Length]
+        if not self.pattern_Cache is None:
+            pattern = self.pattern_Cache.Get(idx % self.base_Length)
+            if not pattern is None:
+                return pattern
 
-        path = os.path.join(self.pattern_Path, self.patterns[idx]).replace('\\', '/')
-        pattern_Dict = pickle.load(open(path, 'rb'))
+        pattern = self.Load(idx % self.base_Length)
+
+        if not self.pattern_Cache is None:
+            self.pattern_Cache.Put(idx % self.base_Length, pattern)
 
-        pattern = pattern_Dict['Duration'], Text_to_Token(pattern_Dict['Text'], self.token_Dict), pattern_Dict['Note'], pattern_Dict['Mel'], pattern_Dict['Silence'], pattern_Dict['Pitch']
-        if self.use_cache:
-            self.cache_Dict[self.metadata_Path, idx % self.base_Length] = pattern
-        
         return pattern
 
     def __len__(self):
-        return len(self.patterns)
+        return self.base_Length * self.accumulated_Dataset_Epoch
+
+    def Load(self, index: int):
+        if self.storage == 'Shard':
+            return self.Shard_Load(index)
+        elif self.storage == 'Song':
+            return self.Window_Load(index)
+
+        path = os.path.join(self.pattern_Path, self.metadata.File(index)).replace('\\', '/')
+        pattern_Dict = Pattern_Load(path)
+
+        return pattern_Dict['Duration'], Text_to_Token(pattern_Dict['Text'], self.token_Dict), pattern_Dict['Note'], pattern_Dict['Mel'], pattern_Dict['Silence'], pattern_Dict['Pitch']
+
+    def Cache_Info(self):
+        return None if self.pattern_Cache is None else self.pattern_Cache.Info()
+
+    def Close(self):
+        if not self.pattern_Cache is None:
+            self.pattern_Cache.Close()
+            self.pattern_Cache = None
+
+    def Window_Load(self, window_index: int):
+        song_Index, start_Index, end_Index, start_Frame, end_Frame = self.metadata.Column('Window_Table')[window_index]  # (File_List index, start_Index, end_Index, start_Frame, end_Frame)
+        song_Dict = self.Song_Load(song_Index)
+
+        return \
+            song_Dict['Duration'][start_Index:end_Index], \
+            song_Dict['Token'][start_Index:end_Index], \
+            song_Dict['Note'][start_Index:end_Index], \
+            np.array(song_Dict['Mel'][start_Frame:end_Frame]), \
+            np.array(song_Dict['Silence'][start_Frame:end_Frame]), \
+            np.array(song_Dict['Pitch'][start_Frame:end_Frame])
+
+    def Song_Load(self, song_index: int):
+        if song_index in self.song_Dict.keys():
+            self.song_Dict.move_to_end(song_index)
+            return self.song_Dict[song_index]
+
+        path = os.path.join(self.pattern_Path, self.metadata.File(song_index)).replace('\\', '/')
+        song_Dict = pickle.load(open(path, 'rb'))
+        song_Dict['Token'] = np.array(Text_to_Token(song_Dict['Text'], self.token_Dict), dtype= np.int64)  # Tokenized once per song, not per window.
+        for key in ('Duration', 'Note'):
+            song_Dict[key] = np.array(song_Dict[key], dtype= np.int64)
+        for key in ('Mel', 'Silence', 'Pitch'):
+            song_Dict[key] = np.load('{}.{}.npy'.format(Song_Array_Path(path, song_Dict), key), mmap_mode= 'r')
+
+        self.song_Dict[song_index] = song_Dict
+        if len(self.song_Dict) > self.max_Open_Songs:
+            self.song_Dict.popitem(last= False)
+
+        return song_Dict
+
+    def Shard_Load(self, window_index: int):
+        if self.shard_Dict is None:
+            self.shard_Dict = {
+                key: np.load(os.path.join(self.pattern_Path, 'SHARD.{}.npy'.format(key)).replace('\\', '/'), mmap_mode= 'r')
+                for key in ['Mel', 'Silence', 'Pitch', 'Duration', 'Token', 'Note']
+                }
+
+        song_Index, start_Index, end_Index, start_Frame, end_Frame = self.metadata.Column('Window_Table')[window_index]  # (File_List index, start_Index, end_Index, start_Frame, end_Frame)
+        frame_Offset, _, music_Offset, _ = self.metadata.Column('Shard_Index')[song_Index]  # (frame_Offset, frame_Length, music_Offset, music_Length)
+        start_Frame, end_Frame = start_Frame + frame_Offset, end_Frame + frame_Offset
+        start_Index, end_Index = start_Index + music_Offset, end_Index + music_Offset
+
+        mel, pitch = [
+            Dequantize(self.shard_Dict[key][start_Frame:end_Frame], *self.shard_Scale[key]) \
+            if key in self.shard_Scale.keys() else \
+            self.shard_Dict[key][start_Frame:end_Frame].astype(np.float32)
+            for key in ['Mel', 'Pitch']
+            ]
+
+        return \
+            self.shard_Dict['Duration'][start_Index:end_Index].astype(np.int64), \
+            self.shard_Dict['Token'][start_Index:end_Index].astype(np.int64), \
+            self.shard_Dict['Note'][start_Index:end_Index].astype(np.int64), \
+            mel, \
+            np.array(self.shard_Dict['Silence'][start_Frame:end_Frame]), \
+            pitch
+
+class Bucket_Batch_Sampler(torch.utils.data.Sampler):
+    '''
+    Batch sampler which groups patterns of similar mel length to reduce the padding of Mel_Stack and Duration_Stack.
+    Every epoch, the indices are shuffled and split to buckets of bucket_size batches.
+    Each bucket is sorted by length and cut to batches, and then the order of all batches is shuffled.
+    Like DistributedSampler, all replicas make the same batches from the seed and epoch, and each replica takes every num_replicas-th batch.
+    lengths: the mel length of each base index. The dataset length can be a multiple of it (Accumulated_Dataset_Epoch).
+    max_frames: when it is given, a batch is filled until (the number of patterns × the longest mel length) reaches it,
+        so the padded mel size of every batch is similar. batch_size is then only the unit of the bucket size.
+    min_length, max_length: patterns out of the range are not sampled. The lengths are compared as an array, so memory-mapped lengths are not copied to Python objects.
+    '''
+    def __init__(
+        self,
+        lengths: np.ndarray,
+        batch_size: int,
+        dataset_length: int= None,
+        bucket_size: int= 32,
+        num_replicas: int= None,
+        rank: int= None,
+        shuffle: bool= True,
+        seed: int= 0,
+        drop_last: bool= False,
+        max_frames: int= None,
+        min_length: int= None,
+        max_length: int= None
+        ):
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size() if torch.distributed.is_available() and torch.distributed.is_initialized() else 1
+        if rank is None:
+            rank = torch.distributed.get_rank() if torch.distributed.is_available() and torch.distributed.is_initialized() else 0
+
+        self.lengths = np.asarray(lengths)
+        self.batch_Size = batch_size
+        self.dataset_Length = dataset_length or self.lengths.shape[0]
+        self.bucket_Size = bucket_size
+        self.num_Replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_Last = drop_last
+        self.max_Frames = max_frames
+        self.epoch = 0
+
+        self.mask = None    # The patterns in the length range
+        self.num_Patterns = self.dataset_Length
+        if not min_length is None or not max_length is None:
+            self.mask = \
+                (self.lengths >= (min_length or 0)) & \
+                (self.lengths <= (max_length if not max_length is None else np.iinfo(np.int64).max))
+            self.num_Patterns = \
+                int(self.mask.sum()) * (self.dataset_Length // self.lengths.shape[0]) + \
+                int(self.mask[:self.dataset_Length % self.lengths.shape[0]].sum())
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def Batches(self):
+        '''
+        All batches of the current epoch before the split of replicas.
+        '''
+        random_State = np.random.RandomState(self.seed + self.epoch)
+        indices = random_State.permutation(self.dataset_Length) if self.shuffle else np.arange(self.dataset_Length)
+        if not self.mask is None:
+            indices = indices[self.mask[indices % self.lengths.shape[0]]]
+
+        batches = []
+        bucket_Length = self.batch_Size * self.bucket_Size
+        for start in range(0, indices.shape[0], bucket_Length):
+            bucket = indices[start:start + bucket_Length]
+            bucket = bucket[np.argsort(self.lengths[bucket % self.lengths.shape[0]], kind= 'stable')]
+            batches.extend(self.Cut(bucket))
+        if self.drop_Last and self.max_Frames is None:
+            batches = [batch for batch in batches if batch.shape[0] == self.batch_Size]
+        if self.shuffle:
+            batches = [batches[index] for index in random_State.permutation(len(batches))]
+
+        # Every replica must have the same number of batches.
+        if self.drop_Last:
+            batches = batches[:len(batches) // self.num_Replicas * self.num_Replicas]
+        elif len(batches) % self.num_Replicas != 0:
+            batches += batches[:self.num_Replicas - len(batches) % self.num_Replicas]
+
+        return batches
+
+    def Cut(self, bucket: np.ndarray):
+        '''
+        bucket: indices sorted by length.
+        '''
+        if self.max_Frames is None:
+            return [bucket[index:index + self.batch_Size] for index in range(0, bucket.shape[0], self.batch_Size)]
+
+        # Because the bucket is sorted, the longest length of bucket[start:index + 1] is the length of the index.
+        batches = []
+        start = 0
+        for index, length in enumerate(self.lengths[bucket % self.lengths.shape[0]]):
+            if index > start and (index - start + 1) * length > self.max_Frames:
+                batches.append(bucket[start:index])
+                start = index
+        batches.append(bucket[start:])
+
+        return batches
+
+    def __iter__(self):
+        for batch in self.Batches()[self.rank::self.num_Replicas]:
+            yield batch.tolist()
+
+    def __len__(self):
+        if not self.max_Frames is None:    # The number of batches depends on the shuffle.
+            return len(self.Batches()[self.rank::self.num_Replicas])
+
+        num_Batches = sum([
+            (min(self.batch_Size * self.bucket_Size, self.num_Patterns - start) // self.batch_Size) if self.drop_Last else \
+            math.ceil(min(self.batch_Size * self.bucket_Size, self.num_Patterns - start) / self.batch_Size)
+            for start in range(0, self.num_Patterns, self.batch_Size * self.bucket_Size)
+            ])
+        return num_Batches // self.num_Replicas if self.drop_Last else math.ceil(num_Batches / self.num_Replicas)
+
+    def Padding_Ratio(self, batches: list= None):
+        '''
+        The ratio of padded frames in the batches. The batches of the current epoch are used when batches is None.
+        '''
+        batches = batches if not batches is None else self.Batches()
+        lengths = [self.lengths[np.asarray(batch) % self.lengths.shape[0]] for batch in batches]
+        total_Frames = sum([length.max() * length.shape[0] for length in lengths])
+
+        return 1.0 - sum([length.sum() for length in lengths]) / max(total_Frames, 1)
+
+class Infinite_Batch_Sampler(torch.utils.data.Sampler):
+    '''
+    Endless stream of the batches of batch_sampler, epoch after epoch, so the DataLoader iterator and its workers are made only once.
+    The position after each yielded batch, (epoch, offset), is queued. DataLoader keeps the batch order,
+    so the trainer pops one state for each received batch and saves it to the checkpoint.
+    A new iterator starts from epoch and offset, so the stream resumes with the same order.
+    '''
+    def __init__(self, batch_sampler: torch.utils.data.Sampler, epoch: int= 0, offset: int= 0):
+        self.batch_Sampler = batch_sampler
+        self.epoch = epoch
+        self.offset = offset
+        self.state_Queue = deque()
+
+    def __iter__(self):
+        self.state_Queue.clear()
+        epoch, offset = self.epoch, self.offset
+        while True:
+            self.batch_Sampler.set_epoch(epoch)
+            batches = list(self.batch_Sampler)
+            if len(batches) == 0:
+                return
+            for index in range(offset, len(batches)):
+                self.state_Queue.append((epoch, index + 1) if index + 1 < len(batches) else (epoch + 1, 0))
+                yield batches[index]
+            epoch, offset = epoch + 1, 0
+
+    def __len__(self):  # Batches of an epoch
+        return len(self.batch_Sampler)
+
+    def Pop_State(self):
+        self.epoch, self.offset = self.state_Queue.popleft()
+
+        return self.epoch, self.offset
+
+class Device_Prefetcher:
+    '''
+    Wraps a DataLoader. A background thread takes the next batches from the loader and moves their tensors to the device
+    while the current step computes. On CUDA, the copies are issued on a side stream and the compute stream waits for them.
+    wait_Time is the seconds that the last batch was waited for. If it is not near zero, the input is the bottleneck.
+    '''
+    def __init__(self, loader, device: torch.device, depth: int= 2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = depth
+        self.wait_Time = 0.0
+
+    def __iter__(self):
+        queue = Queue(maxsize= self.depth)
+        stop_Event = threading.Event()
+        stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+
+        def Put(item):
+            while not stop_Event.is_set():
+                try:
+                    queue.put(item, timeout= 0.1)
+                    return True
+                except Full:
+                    continue
+            return False
+
+        def Load():
+            try:
+                for batch in self.loader:
+                    event = None
+                    if stream is None:
+                        batch = tuple(x.to(self.device) if isinstance(x, torch.Tensor) else x for x in batch)
+                    else:
+                        with torch.cuda.stream(stream):
+                            batch = tuple(x.to(self.device, non_blocking= True) if isinstance(x, torch.Tensor) else x for x in batch)
+                            event = torch.cuda.Event()
+                            event.record(stream)
+                    if not Put((batch, event)):
+                        return
+                Put(None)
+            except Exception as e:
+                Put(e)
+
+        thread = threading.Thread(target= Load, daemon= True)
+        thread.start()
+        try:
+            while True:
+                start_Time = time.perf_counter()
+                item = queue.get()
+                if item is None:
+                    return
+                elif isinstance(item, Exception):
+                    raise item
+
+                batch, event = item
+                if not event is None:
+                    current_Stream = torch.cuda.current_stream(self.device)
+                    current_Stream.wait_event(event)
+                    for x in batch:
+                        if isinstance(x, torch.Tensor):
+                            x.record_stream(current_Stream) # Not to be reused by the allocator of the side stream
+                self.wait_Time = time.perf_counter() - start_Time
+
+                yield batch
+        finally:
+            stop_Event.set()
+
+    def __len__(self):
+        return len(self.loader)
 
 class Inference_Dataset(torch.utils.data.Dataset):
     def __init__(
@@ -138,17 +747,17 @@ class Inference_Dataset(torch.utils.data.Dataset):
             duration, text, note = zip(*music)
             self.patterns.append((duration, text, note, path))
 
-        self.cache_Dict = Manager().dict()
+        self.cache_Dict = {}
 
     def __getitem__(self, idx: int):
         if idx in self.cache_Dict.keys():
-            return self.cache_Dict['Inference', idx]
+            return self.cache_Dict[idx]
 
         duration, text, note, path = self.patterns[idx]
         pattern = duration, Text_to_Token(text, self.token_Dict), note, os.path.splitext(os.path.basename(path))[0]
 
         if self.use_cache:
-            self.cache_Dict['Inference', idx] = pattern
+            self.cache_Dict[idx] = pattern
  
         return pattern
 
@@ -157,37 +766,59 @@ class Inference_Dataset(torch.utils.data.Dataset):
 
 
 class Collater:
+    '''
+    Each field is allocated once at the padded batch size, and every pattern and its padding are copied into its slot.
+    Mels are written directly in [Batch, Mel_dim, Time] layout.
+    When pin_memory is true, the tensors are allocated in pinned memory. Use it only when the collater runs in the main process (num_workers == 0).
+    '''
     def __init__(
         self,
         token_dict: dict,
-        max_abs_mel: float
+        max_abs_mel: float,
+        pin_memory: bool= False
         ):
         self.token_Dict = token_dict
         self.max_ABS_Mel = max_abs_mel
+        self.pin_Memory = pin_memory and torch.cuda.is_available()
 
     def __call__(self, batch: list):
         durations, tokens, notes, mels, silences, pitches = zip(*batch)
-        
-        token_Lengths = [len(token) + 1 for token in tokens]
-        mel_Lengths = [mel.shape[0] for mel in mels]
 
-        durations = Duration_Stack(durations)
-        tokens = Token_Stack(tokens, self.token_Dict)
-        notes = Note_Stack(notes)
-        mels = Mel_Stack(mels, self.max_ABS_Mel)
-        silences = Silence_Stack(silences)
-        pitches = Pitch_Stack(pitches)
+        token_Lengths = [len(token) + 1 for token in tokens]    # 1 is for padding duration(max - sum) and '<X>'.
+        mel_Lengths = [mel.shape[0] for mel in mels]
+        max_Token_Length = max(token_Lengths)
+        max_Mel_Length = max(mel_Lengths)
+
+        duration_Tensor = torch.empty((len(batch), max_Token_Length), dtype= torch.long, pin_memory= self.pin_Memory)  # [Batch, Time]
+        token_Tensor = torch.empty((len(batch), max_Token_Length), dtype= torch.long, pin_memory= self.pin_Memory) # [Batch, Time]
+        note_Tensor = torch.empty((len(batch), max_Token_Length), dtype= torch.long, pin_memory= self.pin_Memory)  # [Batch, Time]
+        mel_Tensor = torch.empty((len(batch), mels[0].shape[1], max_Mel_Length), dtype= torch.float, pin_memory= self.pin_Memory)  # [Batch, Mel_dim, Time]
+        silence_Tensor = torch.empty((len(batch), max_Mel_Length), dtype= torch.float, pin_memory= self.pin_Memory)   # [Batch, Time]
+        pitch_Tensor = torch.empty((len(batch), max_Mel_Length), dtype= torch.float, pin_memory= self.pin_Memory) # [Batch, Time]
+
+        # numpy views of the tensor storages. Each element is written once, by a pattern or by the padding value.
+        duration_Array, token_Array, note_Array = duration_Tensor.numpy(), token_Tensor.numpy(), note_Tensor.numpy()
+        mel_Array, silence_Array, pitch_Array = mel_Tensor.numpy(), silence_Tensor.numpy(), pitch_Tensor.numpy()
+        for index, (duration, token, note, mel, silence, pitch) in enumerate(batch):
+            duration_Array[index, :len(duration)] = duration
+            duration_Array[index, len(duration):] = 0
+            token_Array[index, :len(token)] = token
+            token_Array[index, len(token):] = self.token_Dict['<X>']
+            note_Array[index, :len(note)] = note
+            note_Array[index, len(note):] = 0
+            mel_Array[index, :, :mel.shape[0]] = mel.T
+            mel_Array[index, :, mel.shape[0]:] = -self.max_ABS_Mel
+            silence_Array[index, :silence.shape[0]] = silence
+            silence_Array[index, silence.shape[0]:] = 0.0
+            pitch_Array[index, :pitch.shape[0]] = pitch
+            pitch_Array[index, pitch.shape[0]:] = 0.0
+        duration_Sums = duration_Array.sum(axis= 1)
+        duration_Array[:, -1] = duration_Sums.max() - duration_Sums   # To fit the time after sample
 
-        durations = torch.LongTensor(durations)   # [Batch, Time]
-        tokens = torch.LongTensor(tokens)   # [Batch, Time]
         token_Lengths = torch.LongTensor(token_Lengths) # [Batch]
-        notes = torch.LongTensor(notes)   # [Batch, Time]
-        mels = torch.FloatTensor(mels).transpose(2, 1)   # [Batch, Mel_dim, Time]
         mel_Lengths = torch.LongTensor(mel_Lengths)   # [Batch]
-        silences = torch.FloatTensor(silences)   # [Batch, Time]
-        pitches = torch.FloatTensor(pitches)   # [Batch, Time]
 
-        return durations, tokens, notes, token_Lengths, mels, silences, pitches, mel_Lengths
+        return duration_Tensor, token_Tensor, note_Tensor, token_Lengths, mel_Tensor, silence_Tensor, pitch_Tensor, mel_Lengths
 
 class Inference_Collater:
     def __init__(
@@ -226,7 +857,6 @@ if __name__ == "__main__":
         pattern_path= hp.Train.Train_Pattern.Path,
         Metadata_file= hp.Train.Train_Pattern.Metadata_File,
         token_dict= token_Dict,
-        accumulated_dataset_epoch= hp.Train.Train_Pattern.Accumulated_Dataset_Epoch,
         )
     collater = Collater(
         token_dict= token_Dict,
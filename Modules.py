@@ -20,6 +20,7 @@ class HifiSinger(torch.nn.Module):
         tokens,
         notes,
         token_lengths= None,  # token_length == duration_length == note_length
+        predict_durations: bool= False  # When true, the encodings are expanded by the predicted durations instead of the durations.
         ):
         encoder_Masks = None
         if not token_lengths is None:
@@ -35,14 +36,15 @@ class HifiSinger(torch.nn.Module):
             masks= encoder_Masks
             )
         
-        encodings, predicted_Durations = self.layer_Dict['Duration_Predictor'](
+        encodings, predicted_Durations, durations = self.layer_Dict['Duration_Predictor'](
             encodings= encodings,
-            durations= durations
+            durations= None if predict_durations else durations,
+            masks= encoder_Masks
             )
 
         decoder_Masks = self.Mask_Generate(
             lengths= durations[:, :-1].sum(dim= 1),
-            max_lengths= durations[0].sum()
+            max_lengths= encodings.size(2)
             )
 
         predicted_Mels, predicted_Silences, predicted_Pitches = self.layer_Dict['Decoder'](
@@ -50,10 +52,7 @@ class HifiSinger(torch.nn.Module):
             masks= decoder_Masks
             )
         
-        predicted_Pitches = predicted_Pitches + torch.stack([
-            note.repeat_interleave(duration) / self.hp.Max_Note
-            for note, duration in zip(notes, durations)
-            ], dim= 0)
+        predicted_Pitches = predicted_Pitches + Length_Regulate(notes, durations, max_length= predicted_Pitches.size(1)) / self.hp.Max_Note
         
         predicted_Mels.data.masked_fill_(decoder_Masks.unsqueeze(1), -self.hp.Sound.Max_Abs_Mel)
         predicted_Silences.data.masked_fill_(decoder_Masks, 0.0)   # 0.0 -> Silence, 1.0 -> Voice
@@ -69,6 +68,29 @@ class HifiSinger(torch.nn.Module):
         return sequence >= lengths[:, None]    # [Batch, Time]
 
 
+def Length_Regulate(x: torch.Tensor, durations: torch.LongTensor, max_length: int= None):
+    '''
+    Expands each token by its duration, same to repeat_interleave of each pattern, with one gather for the batch.
+    The token of each frame is found by searchsorted on the cumulative durations. Gradients are summed to the tokens by the gather.
+    x: [Batch, Dim, Token] or [Batch, Token]
+    durations: [Batch, Token]
+    max_length: the frame length of the result. When it is None, the longest duration sum is used, which needs a device-to-host sync.
+    The frames after the duration sum of each pattern are zero.
+    '''
+    cumulative_Durations = durations.cumsum(dim= 1) # [Batch, Token]
+    if max_length is None:
+        max_length = int(cumulative_Durations[:, -1].max())
+    frames = torch.arange(max_length, device= durations.device)[None, :].expand(durations.size(0), -1).contiguous()
+    indices = torch.searchsorted(cumulative_Durations, frames, right= True)  # [Batch, Time], cumulative_Durations[index - 1] <= frame < cumulative_Durations[index]
+    indices = indices.clamp(max= durations.size(1))  # max_length can be longer than the sums.
+
+    x = torch.nn.functional.pad(x, (0, 1))  # The frames after the duration sum take this zero token. It is cheaper than a mask over the frames.
+    if x.dim() == 3:
+        return x.gather(2, indices.unsqueeze(1).expand(-1, x.size(1), -1))
+
+    return x.gather(1, indices)
+
+
 class Discriminators(torch.nn.Module):
     def __init__(self, hyper_parameters: Namespace) -> None:
         super(Discriminators, self).__init__()
@@ -84,19 +106,83 @@ class Discriminators(torch.nn.Module):
                 frequency_range= frequency_Range
                 )
 
+        # When every band has the same size, the crops are stacked to the channels and the discriminators run as one grouped convolution.
+        self.grouped = len(set([end - start for start, end in self.hp.Discriminator.Frequency_Range])) == 1
+
     def forward(
         self,
         x: torch.FloatTensor,
-        lengths: torch.LongTensor
+        lengths: torch.LongTensor,
+        offsets: torch.LongTensor= None
         ):
         '''
-        x: [Batch, Time]
+        x: [Batch, Mel_dim, Time]
+        offsets: [Discriminator, Batch], the first frames of the crops. When it is None, they are sampled uniformly.
         '''
-        return [
-            self.layer_Dict['Discriminator_{}'.format(index)](x, lengths)
+        discriminators = [
+            self.layer_Dict['Discriminator_{}'.format(index)]
             for index in range(len(self.hp.Discriminator.Frequency_Range))
             ]
+        sampling_Length = int(lengths.min())
+        if offsets is None:
+            offsets = Crop_Offsets(lengths, sampling_Length, len(discriminators))
+
+        if not self.grouped:
+            return [
+                discriminator(x, lengths, offsets[index])
+                for index, discriminator in enumerate(discriminators)
+                ]
+
+        x = Crop(x, self.hp.Discriminator.Frequency_Range, offsets, sampling_Length)    # [Batch, Discriminator, Sampled_Dim, Min_Time]
+        for layers in zip(*[discriminator.layer for discriminator in discriminators]):
+            if not isinstance(layers[0], torch.nn.Conv2d):
+                x = layers[0](x)
+                continue
+            x = torch.nn.functional.conv2d(
+                input= x,
+                weight= torch.cat([layer.weight for layer in layers]),
+                bias= None if layers[0].bias is None else torch.cat([layer.bias for layer in layers]),
+                stride= layers[0].stride,
+                padding= layers[0].padding,
+                dilation= layers[0].dilation,
+                groups= len(layers)
+                )
 
+        return list(x.unbind(dim= 1))  # [Batch, Sampled_Dim, Min_Time] * Discriminator
+
+def Crop_Offsets(lengths: torch.LongTensor, sampling_length: int, num_crops: int= 1):
+    '''
+    Uniform first frames in [0, length - sampling_length] of each pattern, same to torch.randint of each pattern without host syncs.
+    lengths: [Batch]
+    returns: [Num_Crops, Batch]
+    '''
+    highs = (lengths - sampling_length + 1).float()
+    offsets = (torch.rand(num_crops, lengths.size(0), device= lengths.device) * highs).long()
+
+    return torch.min(offsets, highs.long() - 1)  # rand * high can be rounded to high.
+
+def Crop(
+    x: torch.FloatTensor,
+    frequency_ranges: List[List[int]],
+    offsets: torch.LongTensor,
+    sampling_length: int
+    ):
+    '''
+    Every crop of every band by one gather.
+    x: [Batch, Mel_dim, Time]
+    frequency_ranges: [[start, end]] * Crop, the same size.
+    offsets: [Crop, Batch]
+    returns: [Batch, Crop, Sampled_Dim, Sampling_Length]
+    '''
+    frequencies = torch.LongTensor([start for start, _ in frequency_ranges]).to(x.device)[:, None] + \
+        torch.arange(frequency_ranges[0][1] - frequency_ranges[0][0], device= x.device)[None, :]   # [Crop, Sampled_Dim]
+    frames = offsets.t()[:, :, None] + torch.arange(sampling_length, device= x.device)[None, None, :] # [Batch, Crop, Sampling_Length]
+
+    return x[
+        torch.arange(x.size(0), device= x.device)[:, None, None, None],
+        frequencies[None, :, :, None],
+        frames[:, :, None, :]
+        ]
 
 
 class Discriminator(torch.nn.Module):
@@ -139,22 +225,18 @@ class Discriminator(torch.nn.Module):
     def forward(
         self,
         x: torch.FloatTensor,
-        lengths: torch.LongTensor
+        lengths: torch.LongTensor,
+        offsets: torch.LongTensor= None
         ):
         '''
         x: [Batch, Mel_dim, Time]
+        offsets: [Batch], the first frames of the crops. When it is None, they are sampled uniformly.
         '''
-        sampling_Length = lengths.min()
-        mels = []
-        for mel, length in zip(x, lengths):
-            offset = torch.randint(
-                low= 0,
-                high= length - sampling_Length + 1,
-                size= (1,)
-                ).to(x.device)
-            mels.append(mel[self.frequency_Range[0]:self.frequency_Range[1], offset:offset + sampling_Length])
-
-        mels = torch.stack(mels).unsqueeze(dim= 1)    # [Batch, 1, Sampled_Dim, Min_Time]
+        sampling_Length = int(lengths.min())
+        if offsets is None:
+            offsets = Crop_Offsets(lengths, sampling_Length)[0]
+
+        mels = Crop(x, [self.frequency_Range], offsets[None], sampling_Length)    # [Batch, 1, Sampled_Dim, Min_Time]
 
         return self.layer(mels).squeeze(dim= 1) # [Batch, Sampled_Dim, Min_Time]
 
@@ -190,6 +272,7 @@ class Encoder(torch.nn.Module):
                 ff_in_kernel_size= self.hp.Encoder.FFT_Block.FeedForward.In_Kernel_Size,
                 ff_out_kernel_size= self.hp.Encoder.FFT_Block.FeedForward.Out_Kernel_Size,
                 ff_channels= self.hp.Encoder.FFT_Block.FeedForward.Channels,
+                attention= self.hp.Encoder.FFT_Block.Attention
                 )
 
     def forward(
@@ -253,8 +336,15 @@ class Duration_Predictor(torch.nn.Module):
     def forward(
         self,
         encodings: torch.FloatTensor,
-        durations: torch.LongTensor= None
+        durations: torch.LongTensor= None,
+        masks: torch.BoolTensor= None
         ):
+        '''
+        encodings: [Batch, Channels, Token]
+        durations: [Batch, Token]. When it is None, the predicted durations are used.
+        masks: [Batch, Token], true for the padding tokens. It is used only with the predicted durations.
+        Returns the expanded encodings, the predicted durations and the durations used for the expansion.
+        '''
         x = encodings
         for index in range(len(self.hp.Duration_Predictor.Conv.Kernel_Size)):
             x = self.layer_Dict['Conv_{}'.format(index)](x)
@@ -263,27 +353,40 @@ class Duration_Predictor(torch.nn.Module):
             x = self.layer_Dict['Dropout_{}'.format(index)](x)
         predicted_Durations = self.layer_Dict['Projection'](x)
 
+        predicted_Durations = predicted_Durations.squeeze(1)
+
         if durations is None:
-            durations = predicted_Durations.ceil().long().clamp(0, self.hp.Max_Duration)
-            durations = torch.stack([
-                (torch.ones_like(duration) if duration.sum() == 0 else duration)
-                for duration in durations
-                ], dim= 0)
-
-            max_Durations = torch.max(torch.cat([duration.sum(dim= 0, keepdim= True) + 1 for duration in durations]))
-            if max_Durations > self.hp.Max_Duration:  # I assume this means failing
-                durations = torch.ones_like(predicted_Durations).long()
-            else:
-                durations = torch.cat([
-                    durations[:, :-1], durations[:, -1:] + max_Durations - durations.sum(dim= 1, keepdim= True)
-                    ], dim= 1)
+            durations = self.Inference_Durations(predicted_Durations, masks)
+
+        x = Length_Regulate(encodings, durations)   # The only device-to-host sync is the frame length.
+
+        return x, predicted_Durations, durations
+
+    def Inference_Durations(
+        self,
+        predicted_durations: torch.FloatTensor,
+        masks: torch.BoolTensor= None
+        ):
+        '''
+        The durations for the expansion from the predicted durations, by tensor operations for the whole batch without host syncs.
+        predicted_durations: [Batch, Token]
+        masks: [Batch, Token], true for the padding tokens. Their durations are zero.
+        A pattern whose durations are all zero gets 1 for each token.
+        A pattern longer than Max_Duration - 1 frames is cut there. Only that pattern is changed.
+        Like Duration_Stack, the last token is extended so every pattern has the longest sum + 1 frames.
+        '''
+        durations = predicted_durations.ceil().long().clamp(0, self.hp.Max_Duration)
+        ones = torch.ones_like(durations)
+        if not masks is None:
+            durations = durations.masked_fill(masks, 0)
+            ones = ones.masked_fill(masks, 0)
+        durations = torch.where(durations.sum(dim= 1, keepdim= True) == 0, ones, durations)
 
-        x = torch.stack([
-            encoding.repeat_interleave(duration, dim= 1)
-            for encoding, duration in zip(encodings, durations)
-            ], dim= 0)
+        cumulative_Durations = durations.cumsum(dim= 1).clamp(max= self.hp.Max_Duration - 1)
+        durations = torch.diff(cumulative_Durations, dim= 1, prepend= torch.zeros_like(cumulative_Durations[:, :1]))
+        durations[:, -1] += cumulative_Durations[:, -1].max() + 1 - cumulative_Durations[:, -1]
 
-        return x, predicted_Durations.squeeze(1)
+        return durations
 
 class Decoder(torch.nn.Module):
     def __init__(self, hyper_parameters: Namespace):
@@ -305,6 +408,8 @@ class Decoder(torch.nn.Module):
                 ff_in_kernel_size= self.hp.Decoder.FFT_Block.FeedForward.In_Kernel_Size,
                 ff_out_kernel_size= self.hp.Decoder.FFT_Block.FeedForward.Out_Kernel_Size,
                 ff_channels= self.hp.Decoder.FFT_Block.FeedForward.Channels,
+                attention= self.hp.Decoder.FFT_Block.Attention,
+                attention_window= self.hp.Decoder.FFT_Block.Attention_Window
                 )
 
         self.layer_Dict['Projection'] = Conv1d(
@@ -341,15 +446,28 @@ class FFT_Block(torch.nn.Module):
         dropout_rate: float,
         ff_in_kernel_size: int,
         ff_out_kernel_size: int,
-        ff_channels: int
+        ff_channels: int,
+        attention: str= 'SDPA',
+        attention_window: int= None
         ):
         super(FFT_Block, self).__init__()
 
         self.layer_Dict = torch.nn.ModuleDict()
-        self.layer_Dict['Multihead_Attention'] = torch.nn.MultiheadAttention(
-            embed_dim= in_channels,
-            num_heads= heads
-            )
+        if attention == 'SDPA':
+            self.layer_Dict['Multihead_Attention'] = Multihead_Attention(
+                embed_dim= in_channels,
+                num_heads= heads,
+                window= attention_window
+                )
+        elif attention == 'Torch':
+            if not attention_window is None:
+                raise ValueError('The attention window is supported by \'SDPA\' attention only.')
+            self.layer_Dict['Multihead_Attention'] = torch.nn.MultiheadAttention(
+                embed_dim= in_channels,
+                num_heads= heads
+                )
+        else:
+            raise ValueError('Unsupported attention: {}'.format(attention))
         self.layer_Dict['LayerNorm_0'] = torch.nn.LayerNorm(
             normalized_shape= in_channels
             )
@@ -378,27 +496,150 @@ class FFT_Block(torch.nn.Module):
     def forward(self, x: torch.FloatTensor, masks: torch.BoolTensor= None):
         '''
         x: [Batch, Channels, Time]
+        masks: [Batch, Time], true for the padding frames.
         '''
-        x = self.layer_Dict['Multihead_Attention'](
-            query= x.permute(2, 0, 1),
-            key= x.permute(2, 0, 1),
-            value= x.permute(2, 0, 1),
-            key_padding_mask= masks
-            )[0].permute(1, 2, 0) + x
+        if isinstance(self.layer_Dict['Multihead_Attention'], Multihead_Attention):
+            x = self.layer_Dict['Multihead_Attention'](x, masks) + x
+        else:
+            sequence_First = x.permute(2, 0, 1)  # [Time, Batch, Channels]
+            x = self.layer_Dict['Multihead_Attention'](
+                query= sequence_First,
+                key= sequence_First,
+                value= sequence_First,
+                key_padding_mask= masks
+                )[0].permute(1, 2, 0) + x
         x = self.layer_Dict['LayerNorm_0'](x.transpose(2, 1)).transpose(2, 1)
         x = self.layer_Dict['Dropout'](x)
 
         if not masks is None:
-            x *= torch.logical_not(masks).unsqueeze(1).float()
+            masks = masks.unsqueeze(1)  # [Batch, 1, Time]
+            x = x.masked_fill(masks, 0.0)
 
         x = self.layer_Dict['Conv'](x) + x
         x = self.layer_Dict['LayerNorm_1'](x.transpose(2, 1)).transpose(2, 1)
         
         if not masks is None:
-            x *= torch.logical_not(masks).unsqueeze(1).float()
+            x = x.masked_fill(masks, 0.0)
 
         return x
 
+def Scaled_Dot_Product_Attention(
+    query: torch.FloatTensor,
+    key: torch.FloatTensor,
+    value: torch.FloatTensor,
+    attn_mask: torch.BoolTensor= None
+    ):
+    '''
+    torch.nn.functional.scaled_dot_product_attention(torch >= 2.0). Older torch computes the same attention by matmuls without the fused kernels.
+    attn_mask: true for the attended keys.
+    '''
+    if hasattr(torch.nn.functional, 'scaled_dot_product_attention'):
+        return torch.nn.functional.scaled_dot_product_attention(
+            query= query,
+            key= key,
+            value= value,
+            attn_mask= attn_mask
+            )
+
+    scores = query @ key.transpose(-2, -1) / math.sqrt(query.size(-1))
+    if not attn_mask is None:
+        scores = scores.masked_fill(torch.logical_not(attn_mask), float('-inf'))
+
+    return torch.softmax(scores, dim= -1) @ value
+
+class Multihead_Attention(torch.nn.Module):
+    '''
+    Self attention with the parameters of torch.nn.MultiheadAttention(without dropout and extra biases), so the checkpoints of both load to each other.
+    The [Batch, Channels, Time] input is projected once without the sequence-first permutes,
+    and the attention is torch.nn.functional.scaled_dot_product_attention, which can use the fused kernels(see Scaled_Dot_Product_Attention).
+    window: When it is not None, each frame attends only to the frames within `window` frames of it, and the memory grows linearly with the time.
+    '''
+    def __init__(self, embed_dim: int, num_heads: int, window: int= None):
+        super(Multihead_Attention, self).__init__()
+        if embed_dim % num_heads != 0:
+            raise ValueError('embed_dim must be divisible by num_heads.')
+        if not window is None and window < 1:
+            raise ValueError('window must be a positive integer or None.')
+        self.embed_dim = embed_dim
+        self.num_heads = num_heads
+        self.window = window
+
+        self.in_proj_weight = torch.nn.Parameter(torch.empty(3 * embed_dim, embed_dim))
+        self.in_proj_bias = torch.nn.Parameter(torch.empty(3 * embed_dim))
+        self.out_proj = torch.nn.Linear(embed_dim, embed_dim)
+
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # Same to torch.nn.MultiheadAttention
+        torch.nn.init.xavier_uniform_(self.in_proj_weight)
+        torch.nn.init.zeros_(self.in_proj_bias)
+        torch.nn.init.zeros_(self.out_proj.bias)
+
+    def forward(self, x: torch.FloatTensor, masks: torch.BoolTensor= None):
+        '''
+        x: [Batch, Channels, Time]
+        masks: [Batch, Time], true for the padding frames. They are not attended.
+        '''
+        batch_Size, channels, time = x.size()
+        queries, keys, values = torch.nn.functional.linear(
+            x.transpose(2, 1),
+            self.in_proj_weight,
+            self.in_proj_bias
+            ).view(batch_Size, time, 3, self.num_heads, channels // self.num_heads).permute(2, 0, 3, 1, 4)   # [Batch, Heads, Time, Head_Dim] * 3
+
+        if self.window is None or self.window >= time - 1:  # When the window covers every frame, it is the full attention.
+            x = Scaled_Dot_Product_Attention(
+                query= queries,
+                key= keys,
+                value= values,
+                attn_mask= None if masks is None else torch.logical_not(masks)[:, None, None, :]   # [Batch, 1, 1, Time], true for the attended frames.
+                )   # [Batch, Heads, Time, Head_Dim]
+        else:
+            x = self.Local_Attention(queries, keys, values, masks)
+        x = self.out_proj(x.transpose(2, 1).reshape(batch_Size, time, channels))
+
+        return x.transpose(2, 1)    # [Batch, Channels, Time]
+
+    def Local_Attention(
+        self,
+        queries: torch.FloatTensor,
+        keys: torch.FloatTensor,
+        values: torch.FloatTensor,
+        masks: torch.BoolTensor= None
+        ):
+        '''
+        The time is split to blocks of `window` frames. The queries of a block attend to the keys of the previous, the same and the next blocks,
+        and the keys further than `window` frames are masked, so the scores are [Batch, Heads, Time, 3 * Window] instead of [Batch, Heads, Time, Time].
+        queries, keys, values: [Batch, Heads, Time, Head_Dim]
+        masks: [Batch, Time], true for the padding frames.
+        '''
+        batch_Size, heads, time, head_Dim = queries.size()
+        blocks = (time + self.window - 1) // self.window
+        padding = blocks * self.window - time
+        if masks is None:
+            masks = torch.zeros(batch_Size, time, dtype= torch.bool, device= queries.device)
+
+        queries = torch.nn.functional.pad(queries, (0, 0, 0, padding)).view(batch_Size, heads, blocks, self.window, head_Dim)
+        keys, values = [
+            torch.nn.functional.pad(x, (0, 0, self.window, padding + self.window)).unfold(2, 3 * self.window, self.window).transpose(4, 3)
+            for x in [keys, values]
+            ]   # [Batch, Heads, Blocks, 3 * Window, Head_Dim]
+        key_Masks = torch.nn.functional.pad(masks, (self.window, padding + self.window), value= True).unfold(1, 3 * self.window, self.window)  # [Batch, Blocks, 3 * Window]
+
+        distances = torch.arange(3 * self.window, device= queries.device)[None, :] - self.window - torch.arange(self.window, device= queries.device)[:, None]  # [Window, 3 * Window], key - query
+        attended = (distances.abs() <= self.window)[None, None] & torch.logical_not(key_Masks)[:, :, None, :]   # [Batch, Blocks, Window, 3 * Window]
+        attended = attended | (distances == 0)[None, None]   # A padding frame attends to itself at least, so no row is empty. Its result is not used.
+
+        x = Scaled_Dot_Product_Attention(
+            query= queries,
+            key= keys,
+            value= values,
+            attn_mask= attended.unsqueeze(1)
+            )   # [Batch, Heads, Blocks, Window, Head_Dim]
+
+        return x.view(batch_Size, heads, blocks * self.window, head_Dim)[:, :, :time]
+
 # https://pytorch.org/tutorials/beginner/transformer_tutorial.html
 class Sinusoidal_Positional_Embedding(torch.nn.Module):
     def __init__(self, channels, dropout=0.1, max_len=5000):
@@ -470,7 +711,6 @@ if __name__ == "__main__":
         pattern_path= hp.Train.Train_Pattern.Path,
         Metadata_file= hp.Train.Train_Pattern.Metadata_File,
         token_dict= token_Dict,
-        accumulated_dataset_epoch= hp.Train.Train_Pattern.Accumulated_Dataset_Epoch,
         )
     collater = Collater(
         token_dict= token_Dict,
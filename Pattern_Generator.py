@@ -1,11 +1,14 @@
 import numpy as np
-import mido, os, pickle, yaml, hgtk, argparse, math
+import mido, os, pickle, yaml, hgtk, argparse, math, hashlib, shutil, tempfile
+from multiprocessing import Pool
+from functools import partial
 from tqdm import tqdm
 from argparse import Namespace  # for type
 
-from Audio import Audio_Prep, Mel_Generate
-from yin import pitch_calc
+from Audio import Audio_Prep, Mel_Extractor, File_Hash
+from yin import pitch_calc, pitch_calc_stream, yin_num_frames
 from Arg_Parser import Recursive_Parse
+from Datasets import Pattern_Header, Pattern_Header_Load, Song_Array_Path, Quantize, Metadata_Index
 
 def Decompose(syllable):
     onset, nucleus, coda = hgtk.letter.decompose(syllable)
@@ -15,13 +18,24 @@ def Decompose(syllable):
 
 def Pattern_Generate(
     hyper_paramters: Namespace,
-    dataset_path: str
+    dataset_path: str,
+    num_workers: int= 1,
+    incremental: bool= False,
+    audio_cache_path: str= None,
+    stream_block_frames: int= None
     ):
+    '''
+    Returns the indices of the songs whose outputs were removed or rewritten.
+    When incremental is true, songs whose hash is the same as the manifest are skipped.
+    When audio_cache_path is given, decoded audios are cached there and reused by the next generation.
+    When stream_block_frames is given, features are calculated by blocks of that many frames (see Feature_Stream).
+    '''
     min_Duration, max_Duration = math.inf, -math.inf
     min_Note, max_Note = math.inf, -math.inf
 
     paths = []
-    for root, _, files in os.walk(dataset_path):
+    for root, dirs, files in os.walk(dataset_path):
+        dirs.sort() # os.walk visits the directories in the filesystem order. Sorting in place fixes the song indices.
         for file in sorted(files):
             if os.path.splitext(file)[1] != '.wav':
                 continue
@@ -29,55 +43,158 @@ def Pattern_Generate(
             midi_Path = wav_Path.replace('Vox.wav', 'Midi.mid')
             paths.append((wav_Path, midi_Path))
 
-    for index, (wav_Path, midi_Path) in enumerate(paths):
-        mid = mido.MidiFile(midi_Path, charset='CP949')
-        midi_Length = sum([msg.time for msg in mid if msg.type != 'marker']) * hyper_paramters.Sound.Sample_Rate
-        music = []
-        current_Lyric = ''
-        previous_Used = 0
-        absolute_Position = 0
-        wrong_Midi = False
-        for message in mid:
-            if not message.type in ['note_on', 'lyrics', 'note_off']:   # Removing end maker.
-                continue
-            if message.type == 'note_on':
-                duration = int(message.time * hyper_paramters.Sound.Sample_Rate) + previous_Used
-                previous_Used = duration % hyper_paramters.Sound.Frame_Shift
-                duration = duration // hyper_paramters.Sound.Frame_Shift
-                music.append((absolute_Position, duration, '<X>', 0))
-                absolute_Position += duration
-            elif message.type == 'lyrics':
-                current_Lyric = Decompose(message.text.strip())
-            elif message.type == 'note_off':
-                duration = int(message.time * hyper_paramters.Sound.Sample_Rate) + previous_Used
-                previous_Used = duration % hyper_paramters.Sound.Frame_Shift
-                duration = duration // hyper_paramters.Sound.Frame_Shift
-                music.append((absolute_Position, 2, current_Lyric[0], message.note))   # Onset
-                absolute_Position += 2
-                music.append((absolute_Position, duration - 4, current_Lyric[1], message.note))  # excepting onset and coda length
-                absolute_Position += duration - 4
-                music.append((absolute_Position, 2, current_Lyric[2], message.note))   # Coda
-                absolute_Position += 2
-
-                if duration - 4 < 2:    # I want nucleus is also longer than 2.
-                    print('\nToo short note. This data is skipped. Please check it: {}, {}'.format(wav_Path, midi_Path))
-                    wrong_Midi = True
-                    break
-        if wrong_Midi:
+    manifest_Path = os.path.join(hyper_paramters.Train.Train_Pattern.Path, 'MANIFEST.PICKLE').replace('\\', '/')
+    manifest_Dict = {}  # wav_Path: {'Hash', 'Index'}
+    if incremental and os.path.exists(manifest_Path):
+        manifest_Dict = pickle.load(open(manifest_Path, 'rb'))
+
+    # Song index is fixed by the sorted path order, so pattern names do not depend on which worker finishes first.
+    # In incremental mode, known songs keep their index and new songs take the indices after the largest one.
+    new_Manifest_Dict = {}
+    jobs = []
+    next_Index = max([-1] + [entry['Index'] for entry in manifest_Dict.values()]) + 1
+    for index, (wav_Path, midi_Path) in enumerate(tqdm(paths, desc= 'Hash', disable= not incremental)):
+        song_Hash = Song_Hash(hyper_paramters, wav_Path, midi_Path)
+        if not incremental:
+            new_Manifest_Dict[wav_Path] = {'Hash': song_Hash, 'Index': index}
+            jobs.append((index, wav_Path, midi_Path))
+        elif wav_Path in manifest_Dict.keys():
+            new_Manifest_Dict[wav_Path] = {'Hash': song_Hash, 'Index': manifest_Dict[wav_Path]['Index']}
+            if manifest_Dict[wav_Path]['Hash'] != song_Hash:
+                jobs.append((manifest_Dict[wav_Path]['Index'], wav_Path, midi_Path))
+        else:
+            new_Manifest_Dict[wav_Path] = {'Hash': song_Hash, 'Index': next_Index}
+            jobs.append((next_Index, wav_Path, midi_Path))
+            next_Index += 1
+
+    # Stale outputs: removed songs and changed songs.
+    stale_Indices = set([
+        entry['Index']
+        for wav_Path, entry in manifest_Dict.items()
+        if not wav_Path in new_Manifest_Dict.keys() or entry['Hash'] != new_Manifest_Dict[wav_Path]['Hash']
+        ])
+    for index in stale_Indices:
+        for pattern_Path in [hyper_paramters.Train.Train_Pattern.Path, hyper_paramters.Train.Eval_Pattern.Path]:
+            shutil.rmtree(os.path.join(pattern_Path, 'NAMS', '{:03d}'.format(index)).replace('\\', '/'), ignore_errors= True)
+    if incremental:
+        print('{} songs are new or changed, {} songs are removed, {} songs are current.'.format(
+            len(jobs),
+            len([wav_Path for wav_Path in manifest_Dict.keys() if not wav_Path in new_Manifest_Dict.keys()]),
+            len(paths) - len(jobs)
+            ))
+
+    if num_workers > 1:
+        with Pool(processes= num_workers) as pool:
+            results = list(tqdm(
+                pool.imap_unordered(
+                    partial(Song_Generate_Star, hyper_paramters= hyper_paramters, use_tqdm= False, audio_cache_path= audio_cache_path, stream_block_frames= stream_block_frames),
+                    jobs
+                    ),
+                total= len(jobs),
+                desc= 'Pattern'
+                ))
+    else:
+        results = [
+            Song_Generate(hyper_paramters, index, wav_Path, midi_Path, audio_cache_path= audio_cache_path, stream_block_frames= stream_block_frames)
+            for index, wav_Path, midi_Path in jobs
+            ]
+
+    for result in results:
+        if result is None:
             continue
+        song_Min_Duration, song_Max_Duration, song_Min_Note, song_Max_Note = result
+        min_Duration, max_Duration = min(song_Min_Duration, min_Duration), max(song_Max_Duration, max_Duration)
+        min_Note, max_Note = min(song_Min_Note, min_Note), max(song_Max_Note, max_Note)
+
+    os.makedirs(os.path.dirname(manifest_Path), exist_ok= True)
+    with open(manifest_Path, 'wb') as f:
+        pickle.dump(new_Manifest_Dict, f, protocol= 4)
+
+    print('Duration range: {} - {}'.format(min_Duration, max_Duration))
+    print('Note range: {} - {}'.format(min_Note, max_Note))
+
+    return stale_Indices | set([index for index, _, _ in jobs])
+
+def Song_Hash(hyper_paramters: Namespace, wav_Path: str, midi_Path: str):
+    '''
+    The hash of the wav and midi bytes and the parameters which change the generated patterns.
+    '''
+    song_Hash = hashlib.sha1()
+    for path in [wav_Path, midi_Path]:
+        File_Hash(path, song_Hash)
+    song_Hash.update(repr((
+        sorted(vars(hyper_paramters.Sound).items()),
+        hyper_paramters.Min_Duration,
+        hyper_paramters.Max_Duration,
+        hyper_paramters.Train.Pattern_Storage,
+        )).encode('utf-8'))
 
-        audio = Audio_Prep(wav_Path, hyper_paramters.Sound.Sample_Rate)[:int(midi_Length)]  # trimming additional silence of end point
-        mel = Mel_Generate(
-            audio,
-            sample_rate= hyper_paramters.Sound.Sample_Rate,
-            num_mel= hyper_paramters.Sound.Mel_Dim,
-            num_frequency= hyper_paramters.Sound.Spectrogram_Dim,
-            window_length= hyper_paramters.Sound.Frame_Length,
-            hop_length= hyper_paramters.Sound.Frame_Shift,
-            mel_fmin= hyper_paramters.Sound.Mel_F_Min,
-            mel_fmax= hyper_paramters.Sound.Mel_F_Max,
-            max_abs_value= hyper_paramters.Sound.Max_Abs_Mel
-            )[:absolute_Position]   # Usually, 1 or 2 step of mel is cut.
+    return song_Hash.hexdigest()
+
+def Song_Generate_Star(args, hyper_paramters: Namespace, use_tqdm: bool= True, audio_cache_path: str= None, stream_block_frames: int= None):
+    return Song_Generate(hyper_paramters, *args, use_tqdm= use_tqdm, audio_cache_path= audio_cache_path, stream_block_frames= stream_block_frames)
+
+def Song_Generate(
+    hyper_paramters: Namespace,
+    index: int,
+    wav_Path: str,
+    midi_Path: str,
+    use_tqdm: bool= True,
+    audio_cache_path: str= None,
+    stream_block_frames: int= None
+    ):
+    '''
+    Returns (min_Duration, max_Duration, min_Note, max_Note) of the song, or None when the midi is skipped.
+    '''
+    mid = mido.MidiFile(midi_Path, charset='CP949')
+    midi_Length = sum([msg.time for msg in mid if msg.type != 'marker']) * hyper_paramters.Sound.Sample_Rate
+    music = []
+    current_Lyric = ''
+    previous_Used = 0
+    absolute_Position = 0
+    wrong_Midi = False
+    for message in mid:
+        if not message.type in ['note_on', 'lyrics', 'note_off']:   # Removing end maker.
+            continue
+        if message.type == 'note_on':
+            duration = int(message.time * hyper_paramters.Sound.Sample_Rate) + previous_Used
+            previous_Used = duration % hyper_paramters.Sound.Frame_Shift
+            duration = duration // hyper_paramters.Sound.Frame_Shift
+            music.append((absolute_Position, duration, '<X>', 0))
+            absolute_Position += duration
+        elif message.type == 'lyrics':
+            current_Lyric = Decompose(message.text.strip())
+        elif message.type == 'note_off':
+            duration = int(message.time * hyper_paramters.Sound.Sample_Rate) + previous_Used
+            previous_Used = duration % hyper_paramters.Sound.Frame_Shift
+            duration = duration // hyper_paramters.Sound.Frame_Shift
+            music.append((absolute_Position, 2, current_Lyric[0], message.note))   # Onset
+            absolute_Position += 2
+            music.append((absolute_Position, duration - 4, current_Lyric[1], message.note))  # excepting onset and coda length
+            absolute_Position += duration - 4
+            music.append((absolute_Position, 2, current_Lyric[2], message.note))   # Coda
+            absolute_Position += 2
+
+            if duration - 4 < 2:    # I want nucleus is also longer than 2.
+                print('\nToo short note. This data is skipped. Please check it: {}, {}'.format(wav_Path, midi_Path))
+                wrong_Midi = True
+                break
+    if wrong_Midi:
+        return None
+
+    audio = Audio_Prep(wav_Path, hyper_paramters.Sound.Sample_Rate, cache_path= audio_cache_path)[:int(midi_Length)]  # trimming additional silence of end point
+    mel_Extractor = Mel_Extractor.Get(
+        sample_rate= hyper_paramters.Sound.Sample_Rate,
+        num_mel= hyper_paramters.Sound.Mel_Dim,
+        num_frequency= hyper_paramters.Sound.Spectrogram_Dim,
+        window_length= hyper_paramters.Sound.Frame_Length,
+        hop_length= hyper_paramters.Sound.Frame_Shift,
+        mel_fmin= hyper_paramters.Sound.Mel_F_Min,
+        mel_fmax= hyper_paramters.Sound.Mel_F_Max,
+        max_abs_value= hyper_paramters.Sound.Max_Abs_Mel
+        )
+    if stream_block_frames is None:
+        mel = mel_Extractor(audio)[:absolute_Position]   # Usually, 1 or 2 step of mel is cut.
 
         pitch = pitch_calc(
             sig= audio,
@@ -91,55 +208,281 @@ def Pattern_Generate(
             )[:absolute_Position] / hyper_paramters.Sound.F0_Max
 
         silence = np.where(np.mean(mel, axis=1) < -3.5, np.zeros_like(np.mean(mel, axis=1)), np.ones_like(np.mean(mel, axis=1)))
+    else:
+        mel, silence, pitch = Feature_Stream(
+            hyper_paramters= hyper_paramters,
+            audio= audio,
+            mel_extractor= mel_Extractor,
+            max_frames= absolute_Position,
+            block_frames= stream_block_frames
+            )
 
-        pattern_Index = 0
-        for start_Index in tqdm(range(len(music)), desc= os.path.basename(wav_Path)):
-            for end_Index in range(start_Index + 1, len(music), 3):
-                music_Sample = music[start_Index:end_Index]
-                sample_Length = music_Sample[-1][0] + music_Sample[-1][1] - music_Sample[0][0]
-                if sample_Length < hyper_paramters.Min_Duration:
-                    continue
-                elif sample_Length > hyper_paramters.Max_Duration:
-                    break
-
-                audio_Sample = audio[music_Sample[0][0] * hyper_paramters.Sound.Frame_Shift:(music_Sample[-1][0] + music_Sample[-1][1]) * hyper_paramters.Sound.Frame_Shift]
-                mel_Sample = mel[music_Sample[0][0]:music_Sample[-1][0] + music_Sample[-1][1]]
-                silence_Sample = silence[music_Sample[0][0]:music_Sample[-1][0] + music_Sample[-1][1]]
-                pitch_Sample = pitch[music_Sample[0][0]:music_Sample[-1][0] + music_Sample[-1][1]]
-
-                _, duration_Sample, text_Sample, Note_Sample = zip(*music_Sample)
-
-                pattern = {
-                    'Audio': audio_Sample.astype(np.float32),
-                    'Mel': mel_Sample.astype(np.float32),
-                    'Silence': silence_Sample.astype(np.uint8),
-                    'Pitch': pitch_Sample.astype(np.float32),
-                    'Duration': duration_Sample,
-                    'Text': text_Sample,
-                    'Note': Note_Sample,
-                    'Singer': 'Female_0',
-                    'Dataset': 'NAMS',
-                    }
-
-                pattern_Path = os.path.join(
-                    hyper_paramters.Train.Train_Pattern.Path if np.random.rand() > 0.001 else hyper_paramters.Train.Eval_Pattern.Path,
-                    'NAMS',
-                    '{:03d}'.format(index),
-                    'NAMS.S_{:03d}.P_{:05d}.pickle'.format(index, pattern_Index)
-                    ).replace('\\', '/')
-                os.makedirs(os.path.dirname(pattern_Path), exist_ok= True)
-                pickle.dump(
-                    pattern,
-                    open(pattern_Path, 'wb'),
-                    protocol=4
-                    )
-                pattern_Index += 1
-
-                min_Duration, max_Duration = min(sample_Length, min_Duration), max(sample_Length, max_Duration)
-        min_Note, max_Note = min(list(zip(*music))[3] + (min_Note,)), max(list(zip(*music))[3] + (max_Note,))
+    return Song_Write(
+        hyper_paramters= hyper_paramters,
+        index= index,
+        music= music,
+        audio= audio,
+        mel= mel,
+        silence= silence,
+        pitch= pitch,
+        use_tqdm= use_tqdm,
+        desc= os.path.basename(wav_Path)
+        )
 
-    print('Duration range: {} - {}'.format(min_Duration, max_Duration))
-    print('Note range: {} - {}'.format(min_Note, max_Note))
+def Song_Write(
+    hyper_paramters: Namespace,
+    index: int,
+    music: list,
+    audio: np.ndarray,
+    mel: np.ndarray,
+    silence: np.ndarray,
+    pitch: np.ndarray,
+    use_tqdm: bool= True,
+    desc: str= None,
+    windows: np.ndarray= None
+    ):
+    '''
+    Splits the windows of a song to train/eval, and saves the patterns of the storage and the metadata sidecars.
+    windows: (start_Index, end_Index, start_Frame, end_Frame). When it is None, all windows by Min_Duration and Max_Duration are used.
+    Returns (min_Duration, max_Duration, min_Note, max_Note) of the song.
+    '''
+    min_Duration, max_Duration = math.inf, -math.inf
+    random_State = np.random.RandomState(index)    # Train/eval split must not depend on the worker process.
+
+    if windows is None:
+        windows = Window_Enumerate(
+            music= music,
+            min_duration= hyper_paramters.Min_Duration,
+            max_duration= hyper_paramters.Max_Duration
+            )
+    if len(windows) > 0:
+        min_Duration = (windows[:, 3] - windows[:, 2]).min()
+        max_Duration = (windows[:, 3] - windows[:, 2]).max()
+    is_Train = random_State.rand(len(windows)) > 0.001
+
+    # Metadata records of this song by pattern path. They are saved as a sidecar and merged by Metadata_Generate.
+    record_Dict = {
+        pattern_Path: {
+            'File_List': [],
+            'Audio_Length_Dict': {},
+            'Mel_Length_Dict': {},
+            'Music_Length_Dict': {},
+            'Window_Table': np.zeros((0, 5), dtype= np.int64),
+            }
+        for pattern_Path in [hyper_paramters.Train.Train_Pattern.Path, hyper_paramters.Train.Eval_Pattern.Path]
+        }
+
+    if hyper_paramters.Train.Pattern_Storage in ['Song', 'Shard']:  # Shard is packed from the song files at Metadata_Generate.
+        array_Path = None   # The eval song uses the arrays of the train song, so the arrays are not written twice.
+        for pattern_Path, split_Windows in [
+            (hyper_paramters.Train.Train_Pattern.Path, windows[is_Train]),
+            (hyper_paramters.Train.Eval_Pattern.Path, windows[~is_Train]),
+            ]:
+            if len(split_Windows) == 0:
+                continue
+            file = Song_Save(
+                pattern_path= pattern_Path,
+                index= index,
+                music= music,
+                windows= split_Windows,
+                audio= audio,
+                mel= mel,
+                silence= silence,
+                pitch= pitch,
+                array_path= array_Path
+                )
+            array_Path = array_Path or os.path.splitext(os.path.join(pattern_Path, file).replace('\\', '/'))[0]
+            record_Dict[pattern_Path]['File_List'].append(file)
+            record_Dict[pattern_Path]['Audio_Length_Dict'][file] = audio.shape[0]
+            record_Dict[pattern_Path]['Mel_Length_Dict'][file] = mel.shape[0]
+            record_Dict[pattern_Path]['Music_Length_Dict'][file] = len(music)
+            record_Dict[pattern_Path]['Window_Table'] = np.concatenate([
+                np.zeros((split_Windows.shape[0], 1), dtype= np.int64),
+                split_Windows
+                ], axis= 1)
+    else:
+        for pattern_Index, (start_Index, end_Index, start_Frame, end_Frame) in enumerate(tqdm(
+            windows,
+            desc= desc,
+            disable= not use_tqdm
+            )):
+            _, duration_Sample, text_Sample, Note_Sample = zip(*music[start_Index:end_Index])
+
+            pattern = {
+                'Audio': audio[start_Frame * hyper_paramters.Sound.Frame_Shift:end_Frame * hyper_paramters.Sound.Frame_Shift].astype(np.float32),
+                'Mel': mel[start_Frame:end_Frame].astype(np.float32),
+                'Silence': silence[start_Frame:end_Frame].astype(np.uint8),
+                'Pitch': pitch[start_Frame:end_Frame].astype(np.float32),
+                'Duration': duration_Sample,
+                'Text': text_Sample,
+                'Note': Note_Sample,
+                'Singer': 'Female_0',
+                'Dataset': 'NAMS',
+                }
+
+            pattern_Path = hyper_paramters.Train.Train_Pattern.Path if is_Train[pattern_Index] else hyper_paramters.Train.Eval_Pattern.Path
+            file = 'NAMS/{:03d}/NAMS.S_{:03d}.P_{:05d}.pickle'.format(index, index, pattern_Index)
+            os.makedirs(os.path.join(pattern_Path, os.path.dirname(file)).replace('\\', '/'), exist_ok= True)
+            header = Pattern_Header(pattern)
+            with open(os.path.join(pattern_Path, file).replace('\\', '/'), 'wb') as f:
+                pickle.dump(header, f, protocol= 4) # Metadata can be rebuilt from this small header without reading the arrays.
+                pickle.dump(pattern, f, protocol= 4)
+
+            record_Dict[pattern_Path]['File_List'].append(file)
+            record_Dict[pattern_Path]['Audio_Length_Dict'][file] = header['Audio_Length']
+            record_Dict[pattern_Path]['Mel_Length_Dict'][file] = header['Mel_Length']
+            record_Dict[pattern_Path]['Music_Length_Dict'][file] = header['Music_Length']
+
+    for pattern_Path, record in record_Dict.items():
+        if len(record['File_List']) == 0:
+            continue
+        with open(os.path.join(pattern_Path, 'NAMS', '{:03d}'.format(index), 'NAMS.S_{:03d}.METADATA.PICKLE'.format(index)).replace('\\', '/'), 'wb') as f:
+            pickle.dump(record, f, protocol= 4)
+
+    notes = list(zip(*music))[3]
+
+    return min_Duration, max_Duration, min(notes), max(notes)
+
+
+def Feature_Stream(
+    hyper_paramters: Namespace,
+    audio: np.ndarray,
+    mel_extractor: Mel_Extractor,
+    max_frames: int,
+    block_frames: int
+    ):
+    '''
+    Streaming version of the mel, silence and pitch calculation in Song_Generate.
+    Features are computed by blocks of block_frames frames and written to temporary memory-maps in the train pattern path,
+    so the memory does not depend on the song length when the audio is also memory-mapped (Audio_Prep with cache_path).
+    Returns (mel, silence, pitch), which are same to the in-memory calculation.
+    '''
+    os.makedirs(hyper_paramters.Train.Train_Pattern.Path, exist_ok= True)
+    def Stream_Array(length, shape, dtype):
+        # The file is removed when the array is released.
+        return np.memmap(
+            tempfile.TemporaryFile(dir= hyper_paramters.Train.Train_Pattern.Path),
+            dtype= dtype,
+            mode= 'w+',
+            shape= (max(length, 1),) + shape
+            )[:length]
+
+    mel_Length = min(mel_extractor.Num_Frames(audio.shape[0]), max_frames)
+    mel = Stream_Array(mel_Length, (hyper_paramters.Sound.Mel_Dim,), np.float32)
+    silence = Stream_Array(mel_Length, (), np.float32)
+    for start_Frame, mel_Block in mel_extractor.Stream(audio, block_frames= block_frames, max_frames= max_frames):
+        mel[start_Frame:start_Frame + mel_Block.shape[0]] = mel_Block
+        silence[start_Frame:start_Frame + mel_Block.shape[0]] = np.mean(mel_Block, axis= 1) >= -3.5
+
+    pitch_Blocks = pitch_calc_stream(
+        sig= audio,
+        sr= hyper_paramters.Sound.Sample_Rate,
+        w_len= hyper_paramters.Sound.Frame_Length,
+        w_step= hyper_paramters.Sound.Frame_Shift,
+        f0_min= hyper_paramters.Sound.F0_Min,
+        f0_max= hyper_paramters.Sound.F0_Max,
+        confidence_threshold= hyper_paramters.Sound.Confidence_Threshold,
+        gaussian_smoothing_sigma = hyper_paramters.Sound.Gaussian_Smoothing_Sigma,
+        block_frames= block_frames,
+        max_frames= max_frames
+        )
+    pitch_Length = min(yin_num_frames(audio.shape[0], hyper_paramters.Sound.Frame_Length, hyper_paramters.Sound.Frame_Shift), max_frames)
+    pitch = Stream_Array(pitch_Length, (), np.float32)
+    for start_Frame, pitch_Block in pitch_Blocks:
+        pitch[start_Frame:start_Frame + pitch_Block.shape[0]] = pitch_Block / hyper_paramters.Sound.F0_Max
+
+    return np.asarray(mel), np.asarray(silence), np.asarray(pitch)
+
+def Window_Enumerate(
+    music: list,
+    min_duration: int,
+    max_duration: int
+    ):
+    '''
+    Returns the window table, [Windows, 4] of (start_Index, end_Index, start_Frame, end_Frame).
+    A window is music[start_Index:end_Index] and covers the frames [start_Frame, end_Frame).
+    end_Index is start_Index + 1 + 3k and the frame length must be in [min_duration, max_duration].
+    Because note end frames are monotonic, the valid k of every start_Index is a range found by searchsorted.
+    '''
+    if len(music) < 2:
+        return np.zeros((0, 4), dtype= np.int64)
+
+    start_Frames = np.array([position for position, _, _, _ in music], dtype= np.int64)
+    end_Frames = start_Frames + np.array([duration for _, duration, _, _ in music], dtype= np.int64)
+    start_Indices = np.arange(len(music))
+
+    # Window (start_Index, end_Index) ends at the note end_Index - 1 = start_Index + 3k.
+    first_Notes = np.maximum(np.searchsorted(end_Frames, start_Frames + min_duration, side= 'left'), start_Indices)
+    last_Notes = np.minimum(np.searchsorted(end_Frames, start_Frames + max_duration, side= 'right') - 1, len(music) - 2)
+    min_Ks = -((start_Indices - first_Notes) // 3)  # ceil
+    max_Ks = (last_Notes - start_Indices) // 3  # floor
+    counts = np.maximum(max_Ks - min_Ks + 1, 0)
+
+    start_Indices = np.repeat(start_Indices, counts)
+    ks = np.repeat(min_Ks, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    end_Indices = start_Indices + 1 + 3 * ks
+
+    return np.stack([
+        start_Indices,
+        end_Indices,
+        start_Frames[start_Indices],
+        end_Frames[end_Indices - 1]
+        ], axis= 1).astype(np.int64)
+
+def Song_Save(
+    pattern_path: str,
+    index: int,
+    music: list,
+    windows: np.ndarray,
+    audio: np.ndarray,
+    mel: np.ndarray,
+    silence: np.ndarray,
+    pitch: np.ndarray,
+    array_path: str= None
+    ):
+    '''
+    Song storage: the arrays of a song are saved once as '.npy' files next to a small pickle.
+    The pickle has the music and the window table, and windows are sliced from the arrays when loading.
+    array_path: the path of another song file of the same song without the extension. When it is given, the arrays are not saved,
+        and the pickle has 'Array_Path' to them (see Datasets.Song_Array_Path).
+    Returns the song file path relative to the pattern path.
+    '''
+    _, durations, texts, notes = zip(*music)
+    song_Path = os.path.join(pattern_path, 'NAMS', '{:03d}'.format(index), 'NAMS.S_{:03d}'.format(index)).replace('\\', '/')
+    os.makedirs(os.path.dirname(song_Path), exist_ok= True)
+
+    array_Dict = {}
+    if array_path is None:
+        for key, array in [
+            ('Audio', np.asarray(audio, dtype= np.float32)),  # No copy of memory-mapped float32 arrays
+            ('Mel', np.asarray(mel, dtype= np.float32)),
+            ('Silence', np.asarray(silence, dtype= np.uint8)),
+            ('Pitch', np.asarray(pitch, dtype= np.float32)),
+            ]:
+            np.save('{}.{}.npy'.format(song_Path, key), array, allow_pickle= False)
+    else:
+        try:
+            array_Dict['Array_Path'] = os.path.relpath(array_path, os.path.dirname(song_Path)).replace('\\', '/')
+        except ValueError:  # Another drive on Windows
+            array_Dict['Array_Path'] = os.path.abspath(array_path).replace('\\', '/')
+
+    pickle.dump(
+        {
+            **array_Dict,
+            'Duration': durations,
+            'Text': texts,
+            'Note': notes,
+            'Window': windows,
+            'Audio_Length': audio.shape[0],
+            'Mel_Length': mel.shape[0],
+            'Singer': 'Female_0',
+            'Dataset': 'NAMS',
+            },
+        open('{}.pickle'.format(song_Path), 'wb'),
+        protocol= 4
+        )
+
+    return 'NAMS/{:03d}/NAMS.S_{:03d}.pickle'.format(index, index)
 
 def Token_Dict_Generate(hyper_parameters: Namespace):
     tokens = \
@@ -156,10 +499,19 @@ def Token_Dict_Generate(hyper_parameters: Namespace):
 
 def Metadata_Generate(
     hyper_parameters: Namespace,
-    eval: bool= False
+    eval: bool= False,
+    song_indices: set= None
     ):
+    '''
+    song_indices: When this is not None and the metadata exists, the metadata is updated in place.
+    Only the patterns of the songs in song_indices are read again, and the entries of the other songs are kept.
+    '''
     pattern_Path = hyper_parameters.Train.Eval_Pattern.Path if eval else hyper_parameters.Train.Train_Pattern.Path
     metadata_File = hyper_parameters.Train.Eval_Pattern.Metadata_File if eval else hyper_parameters.Train.Train_Pattern.Metadata_File
+    storage = 'Song' if hyper_parameters.Train.Pattern_Storage == 'Shard' else hyper_parameters.Train.Pattern_Storage
+    pattern_Keys = \
+        ('Duration', 'Text', 'Note', 'Window', 'Audio_Length', 'Mel_Length', 'Singer', 'Dataset') if storage == 'Song' else \
+        ('Audio', 'Mel', 'Silence', 'Pitch', 'Duration', 'Text', 'Note', 'Singer', 'Dataset')
 
     new_Metadata_Dict = {
         'Spectrogram_Dim': hyper_parameters.Sound.Spectrogram_Dim,
@@ -170,57 +522,258 @@ def Metadata_Generate(
         'Max_Abs_Mel': hyper_parameters.Sound.Max_Abs_Mel,
         'Mel_F_Min': hyper_parameters.Sound.Mel_F_Min,
         'Mel_F_Max': hyper_parameters.Sound.Mel_F_Max,
+        'Storage': storage,
         'File_List': [],
         'Audio_Length_Dict': {},
         'Mel_Length_Dict': {},
         'Music_Length_Dict': {},
         }
+    window_Table = []   # Song storage only. (File_List index, start_Index, end_Index, start_Frame, end_Frame)
+
+    metadata_Path = os.path.join(pattern_Path, metadata_File.upper()).replace("\\", "/")
+    scan_Paths = [pattern_Path]
+    if not song_indices is None and os.path.exists(metadata_Path):
+        metadata_Dict = pickle.load(open(metadata_Path, 'rb'))
+        if metadata_Dict.get('Storage', 'Window') == hyper_parameters.Train.Pattern_Storage:
+            song_Directories = set(['NAMS/{:03d}'.format(index) for index in song_indices])
+            file_Index_Remap = np.full(len(metadata_Dict['File_List']), -1, dtype= np.int64)
+            for index, file in enumerate(metadata_Dict['File_List']):
+                if os.path.dirname(file) in song_Directories:
+                    continue
+                file_Index_Remap[index] = len(new_Metadata_Dict['File_List'])
+                for key in ['Audio_Length_Dict', 'Mel_Length_Dict', 'Music_Length_Dict']:
+                    new_Metadata_Dict[key][file] = metadata_Dict[key][file]
+                new_Metadata_Dict['File_List'].append(file)
+            if storage == 'Song':
+                kept_Windows = metadata_Dict['Window_Table'][file_Index_Remap[metadata_Dict['Window_Table'][:, 0]] >= 0]
+                kept_Windows[:, 0] = file_Index_Remap[kept_Windows[:, 0]]
+                window_Table.append(kept_Windows)
+            scan_Paths = [os.path.join(pattern_Path, directory).replace("\\", "/") for directory in sorted(song_Directories)]
 
     files_TQDM = tqdm(
-        total= sum([len(files) for root, _, files in os.walk(pattern_Path)]),
+        total= sum([
+            len([file for file in files if os.path.splitext(file)[1] == '.pickle'])
+            for scan_Path in scan_Paths
+            for root, _, files in os.walk(scan_Path)
+            ]),
         desc= 'Eval_Pattern' if eval else 'Train_Pattern'
         )
 
-    for root, _, files in os.walk(pattern_Path):
-        for file in files:
+    for root, _, files in [walk for scan_Path in scan_Paths for walk in os.walk(scan_Path)]:
+        # The sidecars written by Pattern_Generate are merged without reading patterns.
+        sidecar_Files = [file for file in files if file.endswith('.METADATA.PICKLE')]
+        for file in sidecar_Files:
             with open(os.path.join(root, file).replace("\\", "/"), "rb") as f:
-                pattern_Dict = pickle.load(f)
-            file = os.path.join(root, file).replace("\\", "/").replace(pattern_Path, '').lstrip('/')
+                record = pickle.load(f)
+            if storage == 'Song':
+                windows = record['Window_Table'].copy()
+                windows[:, 0] += len(new_Metadata_Dict['File_List'])
+                window_Table.append(windows)
+            for file in record['File_List']:
+                for key in ['Audio_Length_Dict', 'Mel_Length_Dict', 'Music_Length_Dict']:
+                    new_Metadata_Dict[key][file] = record[key][file]
+                new_Metadata_Dict['File_List'].append(file)
+            files_TQDM.update(len(record['File_List']))
+        if len(sidecar_Files) > 0:
+            continue
+
+        # No sidecar: the patterns are read. In window storage, only the header of each pattern is read.
+        for file in files:
+            if os.path.splitext(file)[1] != '.pickle':  # Song storage arrays(.npy) and metadata
+                continue
+            path = os.path.join(root, file).replace("\\", "/")
+            file = path.replace(pattern_Path, '').lstrip('/')
             try:
-                if not all([
-                    key in pattern_Dict.keys()
-                    for key in ('Audio', 'Mel', 'Silence', 'Pitch', 'Duration', 'Text', 'Note', 'Singer', 'Dataset')
-                    ]):
-                    continue
-                new_Metadata_Dict['Audio_Length_Dict'][file] = pattern_Dict['Audio'].shape[0]
-                new_Metadata_Dict['Mel_Length_Dict'][file] = pattern_Dict['Mel'].shape[0]
-                new_Metadata_Dict['Music_Length_Dict'][file] = len(pattern_Dict['Duration'])
+                if storage == 'Song':
+                    with open(path, "rb") as f:
+                        pattern_Dict = pickle.load(f)
+                    if not all([key in pattern_Dict.keys() for key in pattern_Keys]):
+                        continue
+                    new_Metadata_Dict['Audio_Length_Dict'][file] = pattern_Dict['Audio_Length']
+                    new_Metadata_Dict['Mel_Length_Dict'][file] = pattern_Dict['Mel_Length']
+                    new_Metadata_Dict['Music_Length_Dict'][file] = len(pattern_Dict['Duration'])
+                    window_Table.append(np.concatenate([
+                        np.full((pattern_Dict['Window'].shape[0], 1), len(new_Metadata_Dict['File_List'])),
+                        pattern_Dict['Window']
+                        ], axis= 1))
+                else:
+                    header = Pattern_Header_Load(path)
+                    if not all([key in header['Keys'] for key in pattern_Keys]):
+                        continue
+                    new_Metadata_Dict['Audio_Length_Dict'][file] = header['Audio_Length']
+                    new_Metadata_Dict['Mel_Length_Dict'][file] = header['Mel_Length']
+                    new_Metadata_Dict['Music_Length_Dict'][file] = header['Music_Length']
                 new_Metadata_Dict['File_List'].append(file)
             except:
                 print('File \'{}\' is not correct pattern file. This file is ignored.'.format(file))
             files_TQDM.update(1)
 
-    with open(os.path.join(pattern_Path, metadata_File.upper()).replace("\\", "/"), 'wb') as f:
+    if storage == 'Song':
+        new_Metadata_Dict['Window_Table'] = np.concatenate(window_Table, axis= 0) if len(window_Table) > 0 else np.zeros((0, 5), dtype= np.int64)
+    if hyper_parameters.Train.Pattern_Storage == 'Shard':
+        new_Metadata_Dict = Shard_Generate(
+            pattern_path= pattern_Path,
+            metadata_dict= new_Metadata_Dict,
+            token_dict= yaml.load(open(hyper_parameters.Token_Path), Loader=yaml.Loader),
+            mel_precision= hyper_parameters.Train.Mel_Precision,
+            pitch_precision= hyper_parameters.Train.Pitch_Precision,
+            keep_song_files= hyper_parameters.Train.Keep_Song_Files
+            )
+
+    with open(metadata_Path, 'wb') as f:
         pickle.dump(new_Metadata_Dict, f, protocol= 4)
+    Metadata_Index.Generate(metadata_Path, new_Metadata_Dict)
 
     print('Metadata generate done.')
 
 
+def Shard_Generate(
+    pattern_path: str,
+    metadata_dict: dict,
+    token_dict: dict,
+    mel_precision: str= 'Float32',
+    pitch_precision: str= 'Float32',
+    keep_song_files: bool= True
+    ):
+    '''
+    Packs the song files of a pattern path into contiguous arrays, 'SHARD.<Key>.npy'.
+    Frame arrays(Mel, Silence, Pitch) and music arrays(Duration, Token, Note) of all songs are concatenated,
+    and 'Shard_Index' of metadata has (frame_Offset, frame_Length, music_Offset, music_Length) of each song.
+    Frame arrays are written and read through np.memmap, so the packing does not hold the whole split in memory.
+    Music arrays are pre-tokenized and saved in the smallest unsigned integer type which holds them.
+    mel_precision: 'Float32', 'Float16' or 'UInt8'. 'UInt8' is quantized in [-Max_Abs_Mel, Max_Abs_Mel].
+    pitch_precision: 'Float32' or 'UInt16'. 'UInt16' is quantized in the observed range of the pitches.
+        The pitch normalized by F0_Max can be slightly over 1, so a fixed [0, 1] range would clip it.
+    'Shard_Scale' of metadata has (scale, offset) of the quantized arrays.
+    keep_song_files: When false, the song arrays and pickles are removed after packing, so the shards replace them instead of copying them.
+    The sidecars are kept. Packing again(-i or -m of Pattern_Generator) needs the song files, so it raises an error without them.
+    Eval songs read the arrays of the train songs(see Song_Save), so the eval path must be packed before the train path removes them.
+    '''
+    song_Paths = [
+        os.path.splitext(os.path.join(pattern_path, file).replace('\\', '/'))[0]
+        for file in metadata_dict['File_List']
+        ]
+    missing_Paths = [song_Path for song_Path in song_Paths if not os.path.exists('{}.pickle'.format(song_Path))]
+    if len(missing_Paths) > 0:  # Checked before the shards are overwritten.
+        raise FileNotFoundError(
+            'The song files of {} songs, such as \'{}\', do not exist. They are removed after packing when Train.Keep_Song_Files is false. '
+            'Please generate the patterns again without -i and -m.'.format(len(missing_Paths), missing_Paths[0])
+            )
+    song_Dicts = [pickle.load(open('{}.pickle'.format(song_Path), 'rb')) for song_Path in song_Paths]
+    array_Paths = [Song_Array_Path('{}.pickle'.format(song_Path), song_Dict) for song_Path, song_Dict in zip(song_Paths, song_Dicts)]
+
+    mel_Lengths = np.array([metadata_dict['Mel_Length_Dict'][file] for file in metadata_dict['File_List']], dtype= np.int64)
+    music_Lengths = np.array([metadata_dict['Music_Length_Dict'][file] for file in metadata_dict['File_List']], dtype= np.int64)
+    frame_Offsets = np.cumsum(mel_Lengths) - mel_Lengths
+    music_Offsets = np.cumsum(music_Lengths) - music_Lengths
+
+    quantization_Dict = {}  # key: (dtype, min_value, max_value)
+    if mel_precision == 'UInt8':
+        quantization_Dict['Mel'] = (np.uint8, -metadata_dict['Max_Abs_Mel'], metadata_dict['Max_Abs_Mel'])
+    if pitch_precision == 'UInt16':
+        pitch_Ranges = [
+            (float(pitch.min(initial= np.inf)), float(pitch.max(initial= -np.inf)))
+            for pitch in [np.load('{}.Pitch.npy'.format(array_Path), mmap_mode= 'r') for array_Path in array_Paths]
+            ]
+        quantization_Dict['Pitch'] = (
+            np.uint16,
+            min([0.0] + [min_Value for min_Value, _ in pitch_Ranges]),  # The zero pitch of the unvoiced frames and of the rest of the shard is kept exactly.
+            max([1.0] + [max_Value for _, max_Value in pitch_Ranges])
+            )
+
+    shard_Dict = {
+        key: np.lib.format.open_memmap(
+            os.path.join(pattern_path, 'SHARD.{}.npy'.format(key)).replace('\\', '/'),
+            mode= 'w+',
+            dtype= quantization_Dict[key][0] if key in quantization_Dict.keys() else dtype,
+            shape= shape
+            )
+        for key, dtype, shape in [
+            ('Mel', np.float16 if mel_precision == 'Float16' else np.float32, (int(mel_Lengths.sum()), metadata_dict['Mel_Dim'])),
+            ('Silence', np.uint8, (int(mel_Lengths.sum()),)),
+            ('Pitch', np.float32, (int(mel_Lengths.sum()),)),
+            ]
+        }
+    music_Dict = {key: [] for key in ['Duration', 'Token', 'Note']}
+
+    for song_Dict, array_Path, frame_Offset, mel_Length in tqdm(
+        zip(song_Dicts, array_Paths, frame_Offsets, mel_Lengths),
+        total= len(song_Paths),
+        desc= 'Shard'
+        ):
+        for key in ['Mel', 'Silence', 'Pitch']:
+            array = np.load('{}.{}.npy'.format(array_Path, key), mmap_mode= 'r')[:mel_Length]
+            if key in quantization_Dict.keys():
+                array, _ = Quantize(array, *quantization_Dict[key])
+            shard_Dict[key][frame_Offset:frame_Offset + array.shape[0]] = array    # Pitch can be shorter than mel. The rest stays zero.
+        music_Dict['Duration'].append(song_Dict['Duration'])
+        music_Dict['Token'].append([token_dict[x] for x in song_Dict['Text']])
+        music_Dict['Note'].append(song_Dict['Note'])
+
+    for shard in shard_Dict.values():
+        shard.flush()
+
+    for key, arrays in music_Dict.items():
+        array = np.concatenate([np.zeros((0,), dtype= np.int64)] + [np.asarray(x, dtype= np.int64) for x in arrays])
+        np.save(
+            os.path.join(pattern_path, 'SHARD.{}.npy'.format(key)).replace('\\', '/'),
+            array.astype(np.min_scalar_type(array.max(initial= 0)))
+            )
+
+    if not keep_song_files:
+        for song_Path in song_Paths:
+            for path in ['{}.pickle'.format(song_Path)] + ['{}.{}.npy'.format(song_Path, key) for key in ['Audio', 'Mel', 'Silence', 'Pitch']]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    metadata_dict['Storage'] = 'Shard'
+    metadata_dict['Shard_Index'] = np.stack([frame_Offsets, mel_Lengths, music_Offsets, music_Lengths], axis= 1).reshape(-1, 4)
+    metadata_dict['Shard_Scale'] = {
+        key: ((max_value - min_value) / np.iinfo(dtype).max, min_value)
+        for key, (dtype, min_value, max_value) in quantization_Dict.items()
+        }
+
+    return metadata_dict
+
 
 if __name__ == "__main__":
     argParser = argparse.ArgumentParser()
-    argParser.add_argument("-d", "--dataset_path", required= True)
+    argParser.add_argument("-d", "--dataset_path")
     argParser.add_argument("-hp", "--hyper_paramters", required= True)
+    argParser.add_argument("-w", "--num_workers", default= 1, type= int)
+    argParser.add_argument("-i", "--incremental", action= 'store_true')
+    argParser.add_argument("-m", "--metadata_only", action= 'store_true')   # Rebuilding metadata from the sidecars or pattern headers.
+    argParser.add_argument("-c", "--audio_cache_path")  # Decoded and resampled audios are cached here.
+    argParser.add_argument("-s", "--stream_block_frames", type= int)   # Bounded-memory feature calculation for long recordings. Use with -c.
     args = argParser.parse_args()
+    if not args.metadata_only and args.dataset_path is None:
+        argParser.error('-d is required unless -m is given')
 
     hp = Recursive_Parse(yaml.load(
         open(args.hyper_paramters, encoding='utf-8'),
         Loader=yaml.Loader
         ))
 
-    Token_Dict_Generate(hyper_parameters= hp)
-    Pattern_Generate(hyper_paramters= hp, dataset_path= args.dataset_path)
-    Metadata_Generate(hp, False)
-    Metadata_Generate(hp, True)
+    # Packing the shards again needs the song files. This is checked before the songs, the manifest, or the metadata are changed.
+    if (args.incremental or args.metadata_only) and hp.Train.Pattern_Storage == 'Shard':
+        if not hp.Train.Keep_Song_Files:
+            argParser.error('-i and -m need Train.Keep_Song_Files true with Shard storage. Otherwise, please generate the patterns again without -i and -m.')
+        for pattern in [hp.Train.Train_Pattern, hp.Train.Eval_Pattern]:
+            metadata_Path = os.path.join(pattern.Path, pattern.Metadata_File.upper()).replace('\\', '/')
+            if not os.path.exists(metadata_Path):
+                continue
+            missing_Files = [
+                file for file in pickle.load(open(metadata_Path, 'rb'))['File_List']
+                if not os.path.exists(os.path.join(pattern.Path, file).replace('\\', '/'))
+                ]
+            if len(missing_Files) > 0:
+                argParser.error('The song files of {} songs, such as \'{}\', were removed after packing. Please generate the patterns again without -i and -m.'.format(len(missing_Files), missing_Files[0]))
+
+    if not args.metadata_only:
+        Token_Dict_Generate(hyper_parameters= hp)
+        song_Indices = Pattern_Generate(hyper_paramters= hp, dataset_path= args.dataset_path, num_workers= args.num_workers, incremental= args.incremental, audio_cache_path= args.audio_cache_path, stream_block_frames= args.stream_block_frames)
+    # Eval is packed first. The eval songs read the arrays of the train songs, which the train packing can remove.
+    Metadata_Generate(hp, True, song_Indices if args.incremental and not args.metadata_only else None)
+    Metadata_Generate(hp, False, song_Indices if args.incremental and not args.metadata_only else None)
 
-    # python Pattern_Generator.py -hp Hyper_Parameters.yaml -d E:/Kor_Music_Confidential
\ No newline at end of file
+    # python Pattern_Generator.py -hp Hyper_Parameters.yaml -d E:/Kor_Music_Confidential -w 8 [-i] [-c E:/Kor_Music_Confidential.Cache] [-s 4096]
\ No newline at end of file
@@ -0,0 +1,241 @@
+import torch
+import numpy as np
+import os, sys, json, yaml, time, shutil, tempfile, argparse, platform
+from tqdm import tqdm
+
+from Arg_Parser import Recursive_Parse
+from Pattern_Generator import Song_Write, Window_Enumerate, Token_Dict_Generate, Metadata_Generate
+from Datasets import Dataset, Collater, Bucket_Batch_Sampler, Infinite_Batch_Sampler
+from Benchmark import Synthetic_Music
+
+
+def Corpus_Generate(
+    hyper_parameters: argparse.Namespace,
+    songs: int,
+    notes: tuple,
+    max_windows: int,
+    seed: int= 0
+    ):
+    '''
+    Writes a synthetic corpus in the on-disk format of hyper_parameters.Train.Pattern_Storage through Song_Write and Metadata_Generate.
+    Music is random notes. Audio, mel, silence and pitch are random arrays of the real shapes and dtypes, because only the loading is measured.
+    notes: (min, max) of the notes of a song. max_windows: windows of a song are subsampled to this number.
+    '''
+    Token_Dict_Generate(hyper_parameters)
+    random_State = np.random.RandomState(seed)
+    for index in tqdm(range(songs), desc= 'Corpus({})'.format(hyper_parameters.Train.Pattern_Storage)):
+        music = Synthetic_Music(notes= random_State.randint(notes[0], notes[1] + 1), seed= random_State.randint(2 ** 31))
+        frames = music[-1][0] + music[-1][1]
+        windows = Window_Enumerate(
+            music= music,
+            min_duration= hyper_parameters.Min_Duration,
+            max_duration= hyper_parameters.Max_Duration
+            )
+        if windows.shape[0] > max_windows:
+            windows = windows[np.sort(random_State.choice(windows.shape[0], max_windows, replace= False))]
+
+        Song_Write(
+            hyper_paramters= hyper_parameters,
+            index= index,
+            music= music,
+            audio= random_State.uniform(-1.0, 1.0, size= frames * hyper_parameters.Sound.Frame_Shift).astype(np.float32),
+            mel= random_State.uniform(-hyper_parameters.Sound.Max_Abs_Mel, hyper_parameters.Sound.Max_Abs_Mel, size= (frames, hyper_parameters.Sound.Mel_Dim)).astype(np.float32),
+            silence= (random_State.rand(frames) > 0.2).astype(np.uint8),
+            pitch= random_State.rand(frames).astype(np.float32),
+            use_tqdm= False,
+            windows= windows
+            )
+
+    Metadata_Generate(hyper_parameters, eval= False)
+
+def Process_Counters(pids: list):
+    '''
+    CPU seconds, major page faults(memory-mapped reads from the storage), read characters(read calls) and read bytes(from the storage)
+    of the processes, summed. Linux only. None when /proc is not available.
+    '''
+    if not os.path.exists('/proc/self/stat'):
+        return None
+
+    counters = {'CPU_Seconds': 0.0, 'Major_Faults': 0, 'Read_Chars': 0, 'Read_Bytes': 0}
+    for pid in pids:
+        try:
+            stat = open('/proc/{}/stat'.format(pid)).read().rsplit(')', 1)[1].split()
+            counters['CPU_Seconds'] += (int(stat[11]) + int(stat[12])) / os.sysconf('SC_CLK_TCK')   # utime, stime
+            counters['Major_Faults'] += int(stat[9])
+            io_Dict = dict(line.split(': ') for line in open('/proc/{}/io'.format(pid)).read().strip().split('\n'))
+            counters['Read_Chars'] += int(io_Dict['rchar'])
+            counters['Read_Bytes'] += int(io_Dict['read_bytes'])
+        except (OSError, KeyError, IndexError):
+            pass
+
+    return counters
+
+def Drop_Caches():
+    '''
+    Linux and root only. The storage is read again by every run.
+    '''
+    os.sync()
+    with open('/proc/sys/vm/drop_caches', 'w') as f:
+        f.write('3\n')
+
+def Run(
+    hyper_parameters: argparse.Namespace,
+    num_workers: int,
+    use_cache: bool,
+    batch_size: int,
+    bucket_size: int,
+    num_batches: int,
+    warmup_batches: int,
+    cache_bytes: int
+    ):
+    token_Dict = yaml.load(open(hyper_parameters.Token_Path), Loader=yaml.Loader)
+    dataset = Dataset(
+        pattern_path= hyper_parameters.Train.Train_Pattern.Path,
+        Metadata_file= hyper_parameters.Train.Train_Pattern.Metadata_File,
+        token_dict= token_Dict,
+        use_cache= use_cache,
+        cache_bytes= cache_bytes
+        )
+    loader = torch.utils.data.DataLoader(
+        dataset= dataset,
+        batch_sampler= Infinite_Batch_Sampler(Bucket_Batch_Sampler(
+            lengths= dataset.mel_Lengths,
+            batch_size= batch_size,
+            bucket_size= max(bucket_size, 1)
+            )),
+        collate_fn= Collater(token_dict= token_Dict, max_abs_mel= hyper_parameters.Sound.Max_Abs_Mel),
+        num_workers= num_workers
+        )
+
+    iterator = iter(loader)
+    for _ in range(warmup_batches):  # Worker start and the first prefetch are not measured.
+        next(iterator)
+    process_Dict = {
+        'Main': [os.getpid()],
+        'Worker': [worker.pid for worker in getattr(iterator, '_workers', [])]
+        }
+    start_Counters = {key: Process_Counters(pids) for key, pids in process_Dict.items()}
+    start_Time = time.perf_counter()
+
+    samples, frames, padded_Frames = 0, 0, 0
+    for _ in range(num_batches):
+        _, _, _, _, mels, _, _, mel_Lengths = next(iterator)
+        samples += mels.size(0)
+        frames += int(mel_Lengths.sum())
+        padded_Frames += mels.size(0) * mels.size(2)
+
+    seconds = time.perf_counter() - start_Time
+    end_Counters = {key: Process_Counters(pids) for key, pids in process_Dict.items()}
+    cache_Info = dataset.Cache_Info()
+    del iterator, loader
+    dataset.Close()
+
+    result = {
+        'Seconds': seconds,
+        'Samples_per_Second': samples / seconds,
+        'Frames_per_Second': frames / seconds,
+        'Padding_Ratio': 1.0 - frames / max(padded_Frames, 1),
+        'Cache_Hit_Rate': None if cache_Info is None else cache_Info['Hit_Rate'],
+        }
+    for process, counters in end_Counters.items():
+        if counters is None:
+            continue
+        for key, value in counters.items():
+            result['{}_{}'.format(process, key)] = value - start_Counters[process][key]
+
+    return result
+
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('-hp', '--hyper_parameters', default= 'Hyper_Parameters.yaml')
+    argParser.add_argument('-p', '--path', help= 'The directory of the synthetic corpora. A temporary directory is used and removed when it is not given.')
+    argParser.add_argument('-s', '--storages', nargs= '+', default= ['Song', 'Shard'], choices= ['Window', 'Song', 'Shard'])
+    argParser.add_argument('--songs', default= 8, type= int)
+    argParser.add_argument('--notes', nargs= 2, default= [100, 300], type= int, help= 'The range of the notes of a song.')
+    argParser.add_argument('--durations', nargs= 2, type= int, help= 'The range of the window length in frames. The default is Min_Duration and Max_Duration.')
+    argParser.add_argument('--max_windows', default= 256, type= int, help= 'The windows of a song are subsampled to this number. Window storage saves every window as a file.')
+    argParser.add_argument('--mel_precision', default= 'Float32', choices= ['Float32', 'Float16', 'UInt8'])
+    argParser.add_argument('-w', '--num_workers', nargs= '+', default= [0, 2], type= int)
+    argParser.add_argument('-c', '--use_cache', nargs= '+', default= [0, 1], type= int, choices= [0, 1])
+    argParser.add_argument('-b', '--batch_sizes', nargs= '+', default= [24], type= int)
+    argParser.add_argument('--bucket_size', default= 32, type= int)
+    argParser.add_argument('--cache_size', default= 512, type= int, help= 'MB of the pattern cache.')
+    argParser.add_argument('-n', '--num_batches', default= 50, type= int)
+    argParser.add_argument('--warmup_batches', default= 2, type= int)
+    argParser.add_argument('--drop_caches', action= 'store_true', help= 'Drops the page cache before every run. Linux and root only.')
+    argParser.add_argument('-o', '--output', help= 'The JSON file. The JSON is printed when it is not given.')
+    args = argParser.parse_args()
+
+    hp = Recursive_Parse(yaml.load(open(args.hyper_parameters, encoding='utf-8'), Loader=yaml.Loader))
+    if not args.durations is None:
+        hp.Min_Duration, hp.Max_Duration = args.durations
+    hp.Train.Mel_Precision = args.mel_precision
+    corpus_Path = args.path or tempfile.mkdtemp()
+
+    report = {
+        'Config': vars(args),
+        'Environment': {
+            'Python': platform.python_version(),
+            'Torch': torch.__version__,
+            'Numpy': np.__version__,
+            'Platform': platform.platform(),
+            'CPUs': os.cpu_count(),
+            },
+        'Corpora': {},
+        'Results': [],
+        }
+    try:
+        for storage in args.storages:
+            hp.Train.Pattern_Storage = storage
+            hp.Train.Train_Pattern.Path = os.path.join(corpus_Path, storage, 'Train').replace('\\', '/')
+            hp.Train.Eval_Pattern.Path = os.path.join(corpus_Path, storage, 'Eval').replace('\\', '/')
+            hp.Token_Path = os.path.join(corpus_Path, storage, 'Token.yaml').replace('\\', '/')
+            if not os.path.exists(os.path.join(hp.Train.Train_Pattern.Path, hp.Train.Train_Pattern.Metadata_File.upper())):
+                Corpus_Generate(
+                    hyper_parameters= hp,
+                    songs= args.songs,
+                    notes= args.notes,
+                    max_windows= args.max_windows
+                    )
+
+            dataset = Dataset(hp.Train.Train_Pattern.Path, hp.Train.Train_Pattern.Metadata_File, {})
+            report['Corpora'][storage] = {
+                'Patterns': dataset.base_Length,
+                'Frames': int(dataset.mel_Lengths.sum()),
+                'Bytes': sum([
+                    os.path.getsize(os.path.join(root, file))
+                    for root, _, files in os.walk(hp.Train.Train_Pattern.Path)
+                    for file in files
+                    ]),
+                }
+            del dataset
+
+            for num_Workers in args.num_workers:
+                for use_Cache in args.use_cache:
+                    for batch_Size in args.batch_sizes:
+                        if args.drop_caches:
+                            Drop_Caches()
+                        result = Run(
+                            hyper_parameters= hp,
+                            num_workers= num_Workers,
+                            use_cache= bool(use_Cache),
+                            batch_size= batch_Size,
+                            bucket_size= args.bucket_size,
+                            num_batches= args.num_batches,
+                            warmup_batches= args.warmup_batches,
+                            cache_bytes= args.cache_size * 2 ** 20
+                            )
+                        result = {'Storage': storage, 'Num_Workers': num_Workers, 'Use_Cache': bool(use_Cache), 'Batch_Size': batch_Size, **result}
+                        report['Results'].append(result)
+                        print('{Storage} workers: {Num_Workers}, cache: {Use_Cache}, batch: {Batch_Size} -> {Samples_per_Second:.1f} samples/s, {Frames_per_Second:.0f} frames/s, padding {Padding_Ratio:.3f}'.format(**result), file= sys.stderr)
+    finally:
+        if args.path is None:
+            shutil.rmtree(corpus_Path, ignore_errors= True)
+
+    if args.output is None:
+        print(json.dumps(report, indent= 2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent= 2)
+
+    # python Pipeline_Benchmark.py -hp Hyper_Parameters.yaml -s Window Song Shard -w 0 2 4 -c 0 1 -b 8 24 -o Pipeline_Benchmark.json
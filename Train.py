@@ -2,7 +2,7 @@ import os
 os.environ['FOR_DISABLE_CONSOLE_CTRL_HANDLER'] = 'T'    # This is ot prevent to be called Fortran Ctrl+C crash in Windows.
 import torch
 import numpy as np
-import logging, yaml, sys, argparse, math
+import logging, yaml, sys, argparse, math, signal
 from tqdm import tqdm
 from collections import defaultdict
 import matplotlib
@@ -12,7 +12,7 @@ from scipy.io import wavfile
 import torch.multiprocessing as mp
 
 from Modules import HifiSinger, Discriminators
-from Datasets import Dataset, Inference_Dataset, Collater, Inference_Collater
+from Datasets import Dataset, Inference_Dataset, Collater, Inference_Collater, Bucket_Batch_Sampler, Infinite_Batch_Sampler, Device_Prefetcher
 from Radam import RAdam
 from Noam_Scheduler import Modified_Noam_Scheduler
 from Logger import Logger
@@ -50,6 +50,7 @@ class Trainer:
             torch.cuda.set_device(0)
 
         self.steps = steps
+        self.eval_Batches = None
 
         self.Datset_Generate()
         self.Model_Generate()
@@ -73,14 +74,15 @@ class Trainer:
             pattern_path= self.hp.Train.Train_Pattern.Path,
             Metadata_file= self.hp.Train.Train_Pattern.Metadata_File,
             token_dict= token_Dict,
-            accumulated_dataset_epoch= self.hp.Train.Train_Pattern.Accumulated_Dataset_Epoch,
-            use_cache = self.hp.Train.Use_Pattern_Cache
+            use_cache = self.hp.Train.Use_Pattern_Cache,
+            cache_bytes= self.hp.Train.Pattern_Cache_Size * 2 ** 20
             )
         eval_Dataset = Dataset(
             pattern_path= self.hp.Train.Eval_Pattern.Path,
             Metadata_file= self.hp.Train.Eval_Pattern.Metadata_File,
             token_dict= token_Dict,
-            use_cache = self.hp.Train.Use_Pattern_Cache
+            use_cache = self.hp.Train.Use_Pattern_Cache and self.hp.Train.Eval_Batch_Cache is None,   # With the batch cache, the eval set is read once.
+            cache_bytes= self.hp.Train.Eval_Pattern_Cache_Size * 2 ** 20
             )
         inference_Dataset = Inference_Dataset(
             token_dict= token_Dict,
@@ -88,45 +90,98 @@ class Trainer:
             use_cache= False
             )
 
+        self.pattern_Datasets = [train_Dataset, eval_Dataset]  # Closed by Train, so the shared memory of the pattern caches is released.
+
+        # A fixed subsample keeps the evaluation time constant when the eval set grows.
+        eval_Lengths = eval_Dataset.mel_Lengths
+        if 0 < self.hp.Train.Eval_Subsample < eval_Dataset.base_Length:
+            eval_Indices = np.sort(np.random.RandomState(0).choice(eval_Dataset.base_Length, self.hp.Train.Eval_Subsample, replace= False))
+            eval_Dataset = torch.utils.data.Subset(eval_Dataset, eval_Indices.tolist())
+            eval_Lengths = eval_Lengths[eval_Indices]
+
         if self.gpu_id == 0:
             logging.info('The number of train patterns = {}.'.format(train_Dataset.base_Length))
-            logging.info('The number of development patterns = {}.'.format(eval_Dataset.base_Length))
+            logging.info('The number of development patterns = {}.'.format(len(eval_Dataset)))
             logging.info('The number of inference patterns = {}.'.format(len(inference_Dataset)))
 
         collater = Collater(
             token_dict= token_Dict,
-            max_abs_mel= self.hp.Sound.Max_Abs_Mel
+            max_abs_mel= self.hp.Sound.Max_Abs_Mel,
+            pin_memory= self.hp.Train.Num_Workers == 0   # With workers, DataLoader pins the batches in the main process.
             )
         inference_Collater = Inference_Collater(
             token_dict= token_Dict,
             max_abs_mel= self.hp.Sound.Max_Abs_Mel
             )
 
+        # Bucket size 1 makes random batches, same to RandomSampler (or DistributedSampler) with Batch_Size.
+        # The frame budget can pack short patterns together only when they are sorted in a bucket, so it uses 32 batches per bucket when Bucket_Size is 0.
+        bucket_Size = self.hp.Train.Bucket_Size or (32 if self.hp.Train.Max_Batch_Frames > 0 else 1)
+        train_Batch_Sampler = Bucket_Batch_Sampler(
+            lengths= train_Dataset.mel_Lengths,
+            batch_size= self.hp.Train.Batch_Size,
+            bucket_size= bucket_Size,
+            max_frames= self.hp.Train.Max_Batch_Frames or None
+            )   # num_replicas and rank are from torch.distributed when multi GPU is used.
+        if self.gpu_id == 0:
+            logging.info('The padding ratio of train batches = {:.3f}.'.format(train_Batch_Sampler.Padding_Ratio()))
+
         self.dataLoader_Dict = {}
         self.dataLoader_Dict['Train'] = torch.utils.data.DataLoader(
             dataset= train_Dataset,
-            sampler= torch.utils.data.DistributedSampler(train_Dataset, shuffle= True) \
-                     if self.hp.Use_Multi_GPU else \
-                     torch.utils.data.RandomSampler(train_Dataset),
-            collate_fn= collater,
-            batch_size= self.hp.Train.Batch_Size,
-            num_workers= self.hp.Train.Num_Workers,
-            pin_memory= True
-            )
-        self.dataLoader_Dict['Eval'] = torch.utils.data.DataLoader(
-            dataset= eval_Dataset,
-            sampler= torch.utils.data.RandomSampler(eval_Dataset),
+            batch_sampler= Infinite_Batch_Sampler(train_Batch_Sampler),    # The iterator is made once, and the workers live until the training ends.
             collate_fn= collater,
-            batch_size= self.hp.Train.Batch_Size,
             num_workers= self.hp.Train.Num_Workers,
             pin_memory= True
             )
+        if not self.hp.Train.Eval_Batch_Cache is None:   # Loaded once by Eval_Batches. All patterns are sorted by length.
+            self.dataLoader_Dict['Eval'] = torch.utils.data.DataLoader(
+                dataset= eval_Dataset,
+                batch_sampler= Bucket_Batch_Sampler(
+                    lengths= eval_Lengths,
+                    batch_size= self.hp.Train.Batch_Size,
+                    bucket_size= max(math.ceil(len(eval_Dataset) / self.hp.Train.Batch_Size), 1),
+                    num_replicas= 1,
+                    rank= 0,
+                    shuffle= False,
+                    max_frames= self.hp.Train.Max_Batch_Frames or None
+                    ),
+                collate_fn= collater,
+                num_workers= self.hp.Train.Num_Workers,
+                pin_memory= True
+                )
+        elif self.hp.Train.Max_Batch_Frames > 0:
+            self.dataLoader_Dict['Eval'] = torch.utils.data.DataLoader(
+                dataset= eval_Dataset,
+                batch_sampler= Bucket_Batch_Sampler(
+                    lengths= eval_Lengths,
+                    batch_size= self.hp.Train.Batch_Size,
+                    bucket_size= bucket_Size,
+                    num_replicas= 1,
+                    rank= 0,
+                    max_frames= self.hp.Train.Max_Batch_Frames
+                    ),  # Evaluation is only done by GPU 0.
+                collate_fn= collater,
+                num_workers= self.hp.Train.Num_Workers,
+                persistent_workers= self.hp.Train.Num_Workers > 0,
+                pin_memory= True
+                )
+        else:
+            self.dataLoader_Dict['Eval'] = torch.utils.data.DataLoader(
+                dataset= eval_Dataset,
+                sampler= torch.utils.data.RandomSampler(eval_Dataset),
+                collate_fn= collater,
+                batch_size= self.hp.Train.Batch_Size,
+                num_workers= self.hp.Train.Num_Workers,
+                persistent_workers= self.hp.Train.Num_Workers > 0,
+                pin_memory= True
+                )
         self.dataLoader_Dict['Inference'] = torch.utils.data.DataLoader(
             dataset= inference_Dataset,
             sampler= torch.utils.data.SequentialSampler(inference_Dataset),
             collate_fn= inference_Collater,
             batch_size= self.hp.Inference_Batch_Size or self.hp.Train.Batch_Size,
-            num_workers= self.hp.Train.Num_Workers,
+            num_workers= 0, # A few texts once per Inference_Interval. Workers are not kept for them.
             pin_memory= True
             )
 
@@ -300,7 +355,11 @@ class Trainer:
             self.scalar_Dict['Train']['Loss/{}'.format(tag)] += loss
 
     def Train_Epoch(self):
-        for durations, tokens, notes, token_lengths, mels, silences, pitches, mel_lengths in self.dataLoader_Dict['Train']:
+        # The train loader is infinite. This returns at Max_Step.
+        train_Prefetcher = Device_Prefetcher(self.dataLoader_Dict['Train'], self.device)
+        for durations, tokens, notes, token_lengths, mels, silences, pitches, mel_lengths in train_Prefetcher:
+            self.dataLoader_Dict['Train'].batch_sampler.Pop_State()
+            self.scalar_Dict['Train']['Time/Data_Wait'] += train_Prefetcher.wait_Time
             self.Train_Step(durations, tokens, notes, token_lengths, mels, silences, pitches, mel_lengths)
             
             if self.steps % self.hp.Train.Checkpoint_Save_Interval == 0:
@@ -312,6 +371,9 @@ class Trainer:
                     for tag, loss in self.scalar_Dict['Train'].items()
                     }
                 self.scalar_Dict['Train']['Learning_Rate/Generator'] = self.scheduler_Dict['Generator'].get_last_lr()
+                cache_Info = self.dataLoader_Dict['Train'].dataset.Cache_Info()
+                if not cache_Info is None:
+                    self.scalar_Dict['Train']['Pattern_Cache/Hit_Rate'] = cache_Info['Hit_Rate']
                 if self.steps >= self.hp.Train.Discriminator_Delay:
                     self.scalar_Dict['Train']['Learning_Rate/Discriminator'] = self.scheduler_Dict['Discriminator'].get_last_lr()
                 self.writer_Dict['Train'].add_scalar_dict(self.scalar_Dict['Train'], self.steps)
@@ -388,6 +450,22 @@ class Trainer:
 
         return predicted_Mels, predicted_Silences, predicted_Pitches, predicted_Durations
 
+    def Eval_Batches(self):
+        '''
+        With Train.Eval_Batch_Cache, the eval set is loaded and collated at the first evaluation, and the batches are reused.
+        'Pinned' keeps them in host memory(pinned by the DataLoader when CUDA is used), and 'Device' keeps them on the device.
+        '''
+        if self.hp.Train.Eval_Batch_Cache is None:
+            return self.dataLoader_Dict['Eval']
+
+        if self.eval_Batches is None:
+            self.eval_Batches = [
+                tuple(x.to(self.device) for x in batch) if self.hp.Train.Eval_Batch_Cache == 'Device' else batch
+                for batch in self.dataLoader_Dict['Eval']
+                ]
+
+        return self.eval_Batches
+
     def Evaluation_Epoch(self):
         if self.gpu_id != 0:
             return
@@ -397,11 +475,14 @@ class Trainer:
         self.model_Dict['Generator'].eval()
         self.model_Dict['Discriminator'].eval()
 
+        eval_Batches = self.Eval_Batches()
+        eval_Prefetcher = Device_Prefetcher(eval_Batches, self.device)
         for step, (durations, tokens, notes, token_lengths, mels, silences, pitches, mel_lengths) in tqdm(
-            enumerate(self.dataLoader_Dict['Eval'], 1),
+            enumerate(eval_Prefetcher, 1),
             desc='[Evaluation]',
-            total= math.ceil(len(self.dataLoader_Dict['Eval'].dataset) / self.hp.Train.Batch_Size)
+            total= len(eval_Batches)
             ):
+            self.scalar_Dict['Evaluation']['Time/Data_Wait'] += eval_Prefetcher.wait_Time
             predicted_Mels, predicted_Silences, predicted_Pitches, predicted_Durations = self.Evaluation_Step(durations, tokens, notes, token_lengths, mels, silences, pitches, mel_lengths)
 
         self.scalar_Dict['Evaluation'] = {
@@ -566,6 +647,9 @@ class Trainer:
         self.scheduler_Dict['Discriminator'].load_state_dict(state_Dict['Discriminator']['Scheduler'])
 
         self.steps = state_Dict['Steps']
+        if 'Data_State' in state_Dict.keys():   # The train stream continues from the saved position.
+            self.dataLoader_Dict['Train'].batch_sampler.epoch = state_Dict['Data_State']['Epoch']
+            self.dataLoader_Dict['Train'].batch_sampler.offset = state_Dict['Data_State']['Offset']
 
         if self.hp.Use_Mixed_Precision:
             if not 'AMP' in state_Dict.keys():
@@ -592,7 +676,11 @@ class Trainer:
                 'Optimizer': self.optimizer_Dict['Discriminator'].state_dict(),
                 'Scheduler': self.scheduler_Dict['Discriminator'].state_dict(),
                 },
-            'Steps': self.steps
+            'Steps': self.steps,
+            'Data_State': {
+                'Epoch': self.dataLoader_Dict['Train'].batch_sampler.epoch,
+                'Offset': self.dataLoader_Dict['Train'].batch_sampler.offset,
+                }
             }
         if self.hp.Use_Mixed_Precision:
             state_Dict['AMP'] = amp.state_dict()
@@ -611,24 +699,28 @@ class Trainer:
             os.makedirs(self.hp.Checkpoint_Path, exist_ok= True)
             copyfile(self.hp_Path, hp_Path)
 
-        if self.steps == 0:
-            self.Evaluation_Epoch()
+        try:
+            if self.steps == 0:
+                self.Evaluation_Epoch()
 
-        if self.hp.Train.Initial_Inference:
-            self.Inference_Epoch()
+            if self.hp.Train.Initial_Inference:
+                self.Inference_Epoch()
 
-        self.tqdm = tqdm(
-            initial= self.steps,
-            total= self.hp.Train.Max_Step,
-            desc='[Training]'
-            )
+            self.tqdm = tqdm(
+                initial= self.steps,
+                total= self.hp.Train.Max_Step,
+                desc='[Training]'
+                )
 
-        while self.steps < self.hp.Train.Max_Step:
-            try:
-                self.Train_Epoch()
-            except KeyboardInterrupt:
-                self.Save_Checkpoint()
-                exit(1)
+            while self.steps < self.hp.Train.Max_Step:
+                try:
+                    self.Train_Epoch()
+                except KeyboardInterrupt:
+                    self.Save_Checkpoint()
+                    exit(1)
+        finally:
+            for dataset in self.pattern_Datasets:
+                dataset.Close()
             
         self.tqdm.close()
         logging.info('Finished training.')
@@ -656,6 +748,7 @@ if __name__ == '__main__':
         Loader=yaml.Loader
         ))
     os.environ['CUDA_VISIBLE_DEVICES'] = hp.Device
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))  # Killed runs also release the shared memory of the pattern caches.
 
     if hp.Use_Multi_GPU:
         mp.spawn(
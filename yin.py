@@ -35,6 +35,7 @@
 
 
 import numpy as np
+from Audio import Padded_Segment
 
 
 def differenceFunction(x, N, tau_max):
@@ -155,6 +156,80 @@ def compute_yin(sig, sr, w_len=512, w_step=256, f0_min=100, f0_max=500,
     return np.array(pitches), np.array(harmonic_rates), argmins, times
 
 
+def compute_yin_batch(sig, sr, w_len=512, w_step=256, f0_min=100, f0_max=500,
+                      harmo_thresh=0.1, center = True, pad_mode='reflect', frame_batch=512):
+    """
+
+    Batched version of compute_yin. Frames are strided views of the signal (no copy), and the
+    difference function, CMND and pitch picking are computed for up to frame_batch frames at once
+    with one 2-D FFT and array operations instead of a Python loop per frame.
+
+    The outputs match compute_yin up to the rounding of the FFT (CMND values differ by less than 1e-9).
+    A frame can only disagree when its CMND lies within that distance of harmo_thresh or its local
+    minimum is flat to that precision, which is rare enough to be ignored for pattern generation.
+
+    :param frame_batch: the number of frames computed by one FFT call. This bounds the memory.
+
+    :returns: same as compute_yin
+    :rtype: tuple
+    """
+    if center:
+        sig = np.pad(sig, (w_step + w_len - sig.shape[0] % w_step) // 2, mode=pad_mode)
+    sig = np.ascontiguousarray(sig, dtype=np.float64)
+
+    tau_min = int(sr / f0_max)
+    tau_max = min(int(sr / f0_min), w_len)
+
+    timeScale = range(0, len(sig) - w_len, w_step)  # time values for each analysis window
+    times = [t/float(sr) for t in timeScale]
+    frames = np.lib.stride_tricks.as_strided(
+        sig,
+        shape=(len(timeScale), w_len),
+        strides=(sig.strides[0] * w_step, sig.strides[0]),
+        writeable=False
+        )
+
+    size = w_len + tau_max
+    p2 = (size // 32).bit_length()
+    nice_numbers = (16, 18, 20, 24, 25, 27, 30, 32)
+    size_pad = min(x * 2 ** p2 for x in nice_numbers if x * 2 ** p2 >= size)
+    taus = np.arange(tau_max)
+
+    pitches = np.zeros(len(timeScale))
+    harmonic_rates = np.zeros(len(timeScale))
+    argmins = np.zeros(len(timeScale))
+
+    for start in range(0, len(timeScale), frame_batch):
+        x = frames[start:start + frame_batch]
+        rows = np.arange(x.shape[0])
+
+        # Difference function, equation (6)
+        x_cumsum = np.concatenate((np.zeros((x.shape[0], 1)), (x * x).cumsum(axis=1)), axis=1)
+        fc = np.fft.rfft(x, size_pad, axis=1)
+        conv = np.fft.irfft(fc * fc.conjugate(), axis=1)[:, :tau_max]
+        df = x_cumsum[:, w_len:w_len - tau_max:-1] + x_cumsum[:, w_len:w_len + 1] - x_cumsum[:, :tau_max] - 2 * conv
+
+        # CMND, equation (8)
+        cmdf = np.ones_like(df)
+        cmdf[:, 1:] = df[:, 1:] * taus[1:] / (np.cumsum(df[:, 1:], axis=1) + 1e-8)
+
+        # First tau under the threshold, then walk down to the local minimum
+        below = cmdf[:, tau_min:] < harmo_thresh
+        voiced = below.any(axis=1) if below.shape[1] > 0 else np.zeros(x.shape[0], dtype=bool)
+        first = below.argmax(axis=1) + tau_min if below.shape[1] > 0 else np.zeros(x.shape[0], dtype=int)
+        stop = np.ones_like(cmdf, dtype=bool)
+        stop[:, :-1] = cmdf[:, 1:] >= cmdf[:, :-1]
+        stop &= taus >= first[:, None]
+        p = np.where(voiced, stop.argmax(axis=1), 0)
+
+        argmin = cmdf.argmin(axis=1)
+        argmins[start:start + x.shape[0]] = np.where(argmin > tau_min, sr / np.maximum(argmin, 1), 0.0)
+        pitches[start:start + x.shape[0]] = np.where(voiced, sr / np.maximum(p, 1), 0.0)
+        harmonic_rates[start:start + x.shape[0]] = np.where(voiced, cmdf[rows, p], cmdf.min(axis=1))
+
+    return pitches, harmonic_rates, argmins.tolist(), times
+
+
 
 
 
@@ -168,9 +243,10 @@ def pitch_calc(
     f0_min=100,
     f0_max=500,
     confidence_threshold=0.85,
-    gaussian_smoothing_sigma = 1.0
+    gaussian_smoothing_sigma = 1.0,
+    batch = True
     ):
-    pitch = compute_yin(
+    pitch = (compute_yin_batch if batch else compute_yin)(
         sig= sig,
         sr= sr,
         w_len= w_len,
@@ -181,4 +257,56 @@ def pitch_calc(
         pitch = gaussian_filter1d(pitch, sigma= gaussian_smoothing_sigma)
     
     return pitch
-    
\ No newline at end of file
+    
+
+def yin_num_frames(length, w_len=1024, w_step=256):
+    '''
+    The number of frames compute_yin returns for a centered signal of the length.
+    '''
+    pad = (w_step + w_len - length % w_step) // 2
+    return len(range(0, length + 2 * pad - w_len, w_step))
+
+def pitch_calc_stream(
+    sig,
+    sr,
+    w_len=1024,
+    w_step=256,
+    f0_min=100,
+    f0_max=500,
+    confidence_threshold=0.85,
+    gaussian_smoothing_sigma = 1.0,
+    block_frames = 4096,
+    max_frames = None
+    ):
+    '''
+    Yields (start_frame, pitch) for every block_frames frames. The pitch is same to pitch_calc.
+    Each block is computed from its own segment of the signal with the YIN padding and the smoothing context,
+    so a memory-mapped signal of any length is processed with constant memory.
+    '''
+    pad = (w_step + w_len - sig.shape[0] % w_step) // 2    # Same to compute_yin
+    total_frames = yin_num_frames(sig.shape[0], w_len, w_step)
+    num_frames = total_frames if max_frames is None else min(total_frames, max_frames)
+    context = int(4.0 * gaussian_smoothing_sigma + 0.5) if gaussian_smoothing_sigma > 0.0 else 0    # gaussian_filter1d radius
+
+    for start_frame in range(0, num_frames, block_frames):
+        end_frame = min(start_frame + block_frames, num_frames)
+        context_start = max(start_frame - context, 0)
+        context_end = min(end_frame + context, total_frames)
+        segment = Padded_Segment(
+            signal= sig,
+            start= context_start * w_step - pad,
+            end= (context_end - 1) * w_step + w_len - pad + 1,  # compute_yin does not use the frame which ends at the last sample.
+            mode= 'reflect'
+            )
+        pitch = compute_yin_batch(
+            sig= segment,
+            sr= sr,
+            w_len= w_len,
+            w_step= w_step,
+            harmo_thresh= 1 - confidence_threshold,
+            center= False
+            )[0]
+        if gaussian_smoothing_sigma > 0.0:
+            pitch = gaussian_filter1d(pitch, sigma= gaussian_smoothing_sigma)
+
+        yield start_frame, pitch[start_frame - context_start:end_frame - context_start]